@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the decoding of API XM responses: json + pd.json_normalize against the
+fast path of ReadDB (orjson when installed + direct construction of the columns).
+
+Usage, from the root of the repository so the working tree of pydataxm is measured
+(and not an installed copy):
+    python -m benchmarks.bench_decode --days 31 --codes 200 --repeat 5
+"""
+
+import argparse
+import json
+import random
+import time
+
+import pandas as pd
+
+from pydataxm.pydataxm import ReadDB, json_loads, orjson
+
+
+def hourly_payload(days: int, codes: int) -> bytes:
+    """Builds a synthetic HourlyEntities response with the structure of the API XM"""
+    items = []
+    for date in pd.date_range('2024-01-01', periods=days, freq='D'):
+        records = []
+        for code in range(codes):
+            values = {'code': 'R{:04d}'.format(code)}
+            values.update({'Hour{:02d}'.format(hour): '{:.2f}'.format(random.random() * 1000) for hour in range(1, 25)})
+            records.append({'Id': 'Recurso', 'Values': values})
+        items.append({'Date': date.strftime('%Y-%m-%d'), 'HourlyEntities': records})
+    return json.dumps({'Items': items}).encode('utf-8')
+
+
+def measure(function, payload: bytes, repeat: int) -> tuple:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function(payload)
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('--codes', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payload = hourly_payload(args.days, args.codes)
+    baseline = lambda raw: pd.json_normalize(json.loads(raw)['Items'], 'HourlyEntities', 'Date', sep='_')
+    fast = lambda raw: ReadDB._normalize(json_loads(raw)['Items'], 'HourlyEntities')
+
+    t_baseline, df_baseline = measure(baseline, payload, args.repeat)
+    t_fast, df_fast = measure(fast, payload, args.repeat)
+    pd.testing.assert_frame_equal(df_baseline, df_fast)
+
+    print('Payload: {:.1f} MB, {} rows, decoder: {}'.format(len(payload) / 2 ** 20, len(df_fast),
+                                                          'orjson' if orjson is not None else 'json'))
+    print('json + json_normalize: {:.3f} s'.format(t_baseline))
+    print('fast path:             {:.3f} s ({:.1f}x)'.format(t_fast, t_baseline / t_fast))
+
+
+if __name__ == '__main__':
+    main()
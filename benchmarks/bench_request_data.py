@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of ReadDB.request_data against the local replay server (pydataxm.replay),
+without calling the API XM. For each entity type and range length it measures rows/sec, peak memory
+of the Python allocations and the number of requests received by the server. The plans of the annual
+case are checked with dry_run, so that no year is requested twice.
+
+Usage, from the root of the repository so the working tree of pydataxm is measured
+(and not an installed copy):
+    python -m benchmarks.bench_request_data --latency 0.05 --codes 20
+    python -m benchmarks.bench_request_data --save baseline.json
+    python -m benchmarks.bench_request_data --compare baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from pydataxm.pydataxm import ReadDB
+from pydataxm.replay import ReplayServer
+
+# (nombre, MetricId, Entity) de los casos medidos
+cases = [
+    ('hourly', 'Gene', 'Recurso'),
+    ('daily', 'VoluUtilDiarEner', 'Embalse'),
+    ('monthly', 'CERE', 'Sistema'),
+    ('annual', 'ReplayAnual', 'Sistema'),
+    ('lists', 'ListadoRecursos', 'Sistema'),
+]
+range_days = [31, 365, 5 * 365]
+
+
+def run_case(server: ReplayServer, coleccion: str, metrica: str, start_date: str, end_date: str) -> dict:
+    """Runs one request_data with a new client and returns its measures"""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Corrida de calentamiento: el servidor guarda las respuestas y no se mide su costo de generarlas
+        client = ReadDB(cache_dir=cache_dir, base_url=server.url)
+        client.request_data(coleccion, metrica, start_date, end_date)
+        client.shutdown()
+
+        client = ReadDB(cache_dir=cache_dir, base_url=server.url)
+        client.get_collections()
+        server.reset()
+        t0 = time.perf_counter()
+        data = client.request_data(coleccion, metrica, start_date, end_date)
+        seconds = time.perf_counter() - t0
+        requests = sum(server.requests.values())
+        bytes_sent = server.bytes_sent
+        client.shutdown()
+
+        # La memoria se mide en una segunda corrida, porque tracemalloc hace más lenta la primera
+        client = ReadDB(cache_dir=cache_dir, base_url=server.url)
+        client.get_collections()
+        tracemalloc.start()
+        client.request_data(coleccion, metrica, start_date, end_date)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        client.shutdown()
+
+    return {'rows': len(data), 'seconds': seconds, 'rows_per_sec': len(data) / seconds if seconds else float('nan'),
+            'peak_mb': peak / 2 ** 20, 'requests': requests, 'mb_received': bytes_sent / 2 ** 20}
+
+
+def check_annual_plan(server: ReplayServer, coleccion: str, metrica: str, start_date: str, end_date: str) -> list:
+    """Ranges of the dry_run plan of an annual entity that cross a calendar year or repeat a year"""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        client = ReadDB(cache_dir=cache_dir, base_url=server.url)
+        plan = client.dry_run(coleccion, metrica, start_date, end_date)
+        client.shutdown()
+    years = [pd.Timestamp(start).year for start, _ in plan.ranges]
+    return [(start, end) for (start, end), year in zip(plan.ranges, years)
+            if pd.Timestamp(end).year != year or years.count(year) > 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency of the replay server')
+    parser.add_argument('--codes', type=int, default=20, help='codes of the entities other than Sistema')
+    parser.add_argument('--end-date', default='2023-12-31')
+    parser.add_argument('--save', default=None, help='writes the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fraction of regression')
+    args = parser.parse_args()
+
+    results = []
+    bad_plans = []
+    end = pd.Timestamp(args.end_date)
+    with ReplayServer(latency=args.latency, codes=args.codes) as server:
+        for name, coleccion, metrica in cases:
+            for days in (range_days if name != 'lists' else [1]):
+                start = (end - pd.Timedelta(days=days - 1)).strftime('%Y-%m-%d')
+                if name == 'annual':
+                    bad_plans += check_annual_plan(server, coleccion, metrica, start, end.strftime('%Y-%m-%d'))
+                result = run_case(server, coleccion, metrica, start, end.strftime('%Y-%m-%d'))
+                results.append({'case': name, 'days': days, **result})
+
+    table = pd.DataFrame(results)
+    with pd.option_context('display.width', 200, 'display.float_format', '{:,.3f}'.format):
+        print(table.to_string(index=False))
+
+    if bad_plans:
+        print('Rangos anuales que cruzan o repiten un año: {}'.format(bad_plans))
+        sys.exit(1)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = pd.DataFrame(json.load(file)).set_index(['case', 'days'])
+        current = table.set_index(['case', 'days'])
+        common = current.index.intersection(baseline.index)
+        slower = current.loc[common, 'rows_per_sec'] < baseline.loc[common, 'rows_per_sec'] * (1 - args.tolerance)
+        heavier = current.loc[common, 'peak_mb'] > baseline.loc[common, 'peak_mb'] * (1 + args.tolerance)
+        more_requests = current.loc[common, 'requests'] > baseline.loc[common, 'requests']
+        regressions = common[slower | heavier | more_requests]
+        if len(regressions):
+            print('Regresiones frente a {}: {}'.format(args.compare, list(regressions)))
+            sys.exit(1)
+        print('Sin regresiones frente a {}'.format(args.compare))
+
+
+if __name__ == '__main__':
+    main()
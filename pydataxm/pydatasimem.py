@@ -6,15 +6,39 @@ Author: Sebastian Montoya
 """
 
 import os
+import re
+import json
+import codecs
+import hashlib
+import pickle
+import random
+import unicodedata
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import logging
+import numpy as np
 import pandas as pd
 from dataclasses import dataclass
 import datetime as dt
 from datetime import timedelta
 from itertools import repeat
+from array import array
 import time 
 from pprint import pprint
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import polars
+except ImportError:
+    polars = None
 
 global datasetid, variable_inventory_id, catalog_id, reference_date, base_api_url, base_api_info_url, base_api_data_url, url_json_variables, today, version_dataset_id, daily_dataset_id, version_column_df_ver, date_format, dic_filters_op
 datasetid = ""
@@ -30,6 +54,14 @@ url_json_variables = 'https://www.simem.co/backend-datos/vars/listado_variables.
 version_dataset_id = '24914F'
 daily_dataset_id = '7a30a3'
 version_column_df_ver = 'Version'
+accept_encoding = make_headers(accept_encoding=True)['accept-encoding']
+max_workers = 8
+max_retries = 3
+backoff_factor = 0.5  # segundos
+max_backoff = 30  # segundos
+retry_status = (429, 500, 502, 503, 504)
+read_chunk_size = 2 ** 16
+_stats_lock = threading.Lock()
 dic_filters_op = {
     "=":"eq",
     "!=":"neq",
@@ -130,6 +162,554 @@ class _Validation:
             else:
                 return operation, values
 
+    @staticmethod
+    def output(output: str):
+        if output not in ('pandas', 'arrow', 'polars'):
+            raise ValueError("The output must be 'pandas', 'arrow' or 'polars'")
+        if output != 'pandas' and pyarrow is None:
+            raise ImportError(f"The output '{output}' requires pyarrow, install it with: pip install pyarrow")
+        if output == 'polars' and polars is None:
+            raise ImportError("The output 'polars' requires polars, install it with: pip install polars")
+        return output
+
+    @staticmethod
+    def file_format(file_format: str):
+        if file_format not in _DatasetSink.extensions:
+            raise ValueError("The file_format must be 'csv', 'parquet' or 'feather'")
+        if file_format != 'csv' and pyarrow is None:
+            raise ImportError(f"The file_format '{file_format}' requires pyarrow, install it with: pip install pyarrow")
+        return file_format
+
+    @staticmethod
+    def values_dtype(values_dtype: str):
+        if values_dtype not in ('float64', 'float32'):
+            raise ValueError("The values_dtype must be 'float64' or 'float32'")
+        return values_dtype
+
+# Tipos de columna de la metadata de SIMEM, se buscan en el dataType sin tildes ni mayúsculas
+column_kinds = {
+    'fecha': 'datetime',
+    'date': 'datetime',
+    'timestamp': 'datetime',
+    'decimal': 'float',
+    'float': 'float',
+    'double': 'float',
+    'numeric': 'float',
+    'numerico': 'float',
+    'entero': 'integer',
+    'integer': 'integer',
+    'int': 'integer',
+    'texto': 'text',
+    'string': 'text',
+    'varchar': 'text',
+}
+
+def _column_kind(name: str, data_type: str) -> str | None:
+    """
+    Returns the kind of a column ('datetime', 'float', 'integer', 'category' or 'text') from its
+    dataType in the metadata, None when the type is unknown. Text columns of codes are categories.
+    """
+    if not isinstance(data_type, str):
+        return None
+    data_type = unicodedata.normalize('NFKD', data_type).encode('ascii', 'ignore').decode().lower()
+    kind = next((kind for key, kind in column_kinds.items() if key in data_type), None)
+    if kind == 'text' and str(name).startswith('Codigo'):
+        return 'category'
+    return kind
+
+def _typed_column(values, kind: str | None, values_dtype: str = 'float64', name: str = None):
+    """
+    Converts the values of a column to the type of its kind. The conversion is strict: when some
+    value that is not empty does not match the kind, the column keeps its values and a warning is logged.
+    
+    Parameters:
+    values : np.ndarray | list | pd.Series
+        The values of the column.
+    kind : str
+        The kind returned by _column_kind, None keeps the values.
+    values_dtype : str
+        The dtype of the decimal columns, 'float64' or 'float32'.
+    name : str
+        The name of the column, for the warning.
+    
+    Returns:
+    The typed values: datetime64[ns], float, int64, categorical or the same values.
+    """
+    numeric = isinstance(values, np.ndarray) and values.dtype.kind in 'if'
+    if kind == 'datetime' and not numeric:
+        convert = lambda errors: pd.to_datetime(values, format='ISO8601', errors=errors)
+    elif kind == 'float' or (kind == 'integer' and not numeric):
+        convert = lambda errors: pd.to_numeric(values, errors=errors)
+    elif kind == 'category':
+        return pd.Categorical(values)
+    else:
+        return values
+
+    try:
+        typed = convert('raise')
+    except (ValueError, TypeError, OverflowError):
+        # Los textos vacíos quedan como nulos, cualquier otro valor que no cumpla el tipo deja la columna sin tipo
+        typed = convert('coerce')
+        lost = np.asarray(pd.isna(typed)) & ~np.asarray(pd.isna(values))
+        if any(str(value).strip() for value in np.asarray(values, dtype=object)[lost]):
+            logging.warning("The column %s has values that are not %s as in the metadata, it is kept without type.",
+                            name, kind)
+            return values
+    if kind == 'float':
+        return typed.astype(values_dtype, copy=False)
+    return typed
+
+_records_start = re.compile(r'"records"\s*:\s*\[')
+_array_start = re.compile(r'\s*\[')
+_separator = re.compile(r'[\s,]*')
+
+def _iter_records(chunks):
+    """
+    Reads the records of a data response while its chunks arrive, without keeping the whole body.
+    The records can be the top level array of the response or the array result.records. Each record
+    is decoded with json.JSONDecoder.raw_decode, a record cut between two chunks is decoded when the 
+    next chunk arrives.
+    
+    Parameters:
+    chunks : iterable
+        The decompressed chunks of the response body.
+    
+    Returns:
+    generator
+        The records as dictionaries, in the order of the response.
+    """
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    decoder = json.JSONDecoder()
+    buffer = ''
+    inside = False
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        if not inside:
+            match = _array_start.match(buffer) or _records_start.search(buffer)
+            if match is None:
+                continue
+            buffer = buffer[match.end():]
+            inside = True
+        position = 0
+        while True:
+            position = _separator.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == ']':
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            yield record
+        buffer = buffer[position:]
+    buffer += text_decoder.decode(b'', final=True)
+    if inside:
+        raise ValueError("Incomplete response, the records were not closed")
+    if buffer.strip():
+        # Respuesta sin result.records, por ejemplo un mensaje de error de la API
+        data = json.loads(buffer)
+        yield from (data.get('result') or {}).get('records') or []
+
+class _RecordBuffers:
+    """
+    Column buffers where the records of a dataset are appended one by one. Integer and decimal
+    columns are kept in typed arrays and the text columns in lists with a single copy of each value,
+    so the records are never kept as dictionaries.
+    
+    The columns and their types are the same of pd.DataFrame.from_records: a missing value turns
+    an integer column into decimal (NaN) and a column with mixed types is kept as objects.
+    """
+
+    def __init__(self):
+        self.rows: int = 0
+        self.__columns: dict = {}
+        self.__strings: dict = {}
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __new_column(self, name: str, value):
+        if type(value) is float or (type(value) is int and self.rows):
+            column = array('d', [np.nan]) * self.rows
+        elif type(value) is int:
+            column = array('q')
+        else:
+            column = [np.nan] * self.rows
+        self.__columns[name] = column
+        self.__strings[name] = {}
+        return column
+
+    def __to_float(self, name: str):
+        column = array('d', self.__columns[name])
+        self.__columns[name] = column
+        return column
+
+    def __to_list(self, name: str):
+        column = self.__columns[name].tolist()
+        self.__columns[name] = column
+        return column
+
+    def __push(self, name: str, column, value):
+        kind = type(value)
+        if type(column) is list:
+            if kind is str:
+                value = self.__strings[name].setdefault(value, value)
+            column.append(value)
+            return
+        if column.typecode == 'q':
+            if kind is int:
+                try:
+                    column.append(value)
+                    return
+                except OverflowError:
+                    pass
+            elif kind is float or value is None:
+                column = self.__to_float(name)
+        if column.typecode == 'd':
+            if value is None:
+                column.append(np.nan)
+                return
+            if kind is float or (kind is int and -2 ** 63 <= value < 2 ** 63):
+                column.append(value)
+                return
+        self.__push(name, self.__to_list(name), value)
+
+    def append(self, record: dict) -> None:
+        """
+        Appends a record to the columns. The columns missing in the record get a missing value.
+        """
+        columns = self.__columns
+        for name, value in record.items():
+            column = columns.get(name)
+            if column is None:
+                column = self.__new_column(name, value)
+            kind = type(value)
+            if type(column) is list:
+                column.append(self.__strings[name].setdefault(value, value) if kind is str else value)
+            elif kind is float and column.typecode == 'd':
+                column.append(value)
+            else:
+                self.__push(name, column, value)
+        self.rows += 1
+        if len(record) != len(columns):
+            for name, column in list(columns.items()):
+                if len(column) < self.rows:
+                    self.__push(name, column, None if type(column) is not list else np.nan)
+
+    def extend(self, other: "_RecordBuffers") -> None:
+        """
+        Appends the rows of other buffers after the rows of these ones.
+        """
+        for name, values in other.__columns.items():
+            column = self.__columns.get(name)
+            if column is None:
+                column = self.__new_column(name, values[0] if len(values) else None)
+            if type(column) is not list and type(values) is not list:
+                if column.typecode == 'q' and values.typecode == 'd':
+                    column = self.__to_float(name)
+                column.extend(values if values.typecode == column.typecode else array('d', values))
+                continue
+            if type(column) is not list:
+                column = self.__to_list(name)
+            strings = self.__strings[name]
+            column.extend(strings.setdefault(value, value) if type(value) is str else value for value in values)
+        self.rows += other.rows
+        for name, column in list(self.__columns.items()):
+            if len(column) < self.rows:
+                missing = self.rows - len(column)
+                if type(column) is list:
+                    column.extend([np.nan] * missing)
+                else:
+                    column = self.__to_float(name) if column.typecode == 'q' else column
+                    column.extend(array('d', [np.nan]) * missing)
+
+    def __arrays(self, kinds: dict = None, values_dtype: str = 'float64') -> dict:
+        kinds = kinds or {}
+        arrays = {}
+        for name, column in self.__columns.items():
+            if type(column) is not list:
+                column = np.frombuffer(column, dtype=np.int64 if column.typecode == 'q' else np.float64)
+            arrays[name] = _typed_column(column, kinds.get(name), values_dtype, name)
+        return arrays
+
+    def to_pandas(self, kinds: dict = None, values_dtype: str = 'float64') -> pd.DataFrame:
+        """
+        Returns the records as a DataFrame, the numeric columns are not copied.
+        
+        Parameters:
+        kinds : dict
+            Kind of each column (see _column_kind) to build typed columns, None keeps the JSON types.
+        values_dtype : str
+            The dtype of the decimal columns.
+        """
+        if not self.__columns:
+            return pd.DataFrame()
+        return pd.DataFrame(self.__arrays(kinds, values_dtype), copy=False)
+
+    def to_arrow(self, kinds: dict = None, values_dtype: str = 'float64'):
+        """
+        Returns the records as a pyarrow.Table with one array per column, typed as in to_pandas.
+        """
+        columns = {}
+        for name, column in self.__arrays(kinds, values_dtype).items():
+            try:
+                columns[name] = pyarrow.array(column, from_pandas=True)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                # Columna con tipos mezclados, se conserva como texto
+                columns[name] = pyarrow.array([None if pd.isna(value) else str(value) for value in column], pyarrow.string())
+        return pyarrow.table(columns)
+
+class _DatasetSink:
+    """
+    Writes the date ranges of a dataset to files while they are received, so the dataset is never
+    serialized complete. The files are CSV, Parquet or Feather (Arrow IPC) and are named
+    DATASETID_startdate_enddate. With partitioned=True each requested date range goes to its own file
+    (one month for hourly and daily datasets), otherwise all of them are appended to a single file.
+    
+    The columns of a file are those of its first date range plus the columns of the metadata, with the
+    types of the metadata for the columns without values. A later date range with new columns or wider
+    types (an integer column with decimals, values in a column that was empty) rewrites the file by 
+    batches with the promoted schema. The categories are kept in Parquet and in the partitioned Feather 
+    files, a single Feather file keeps them as text.
+    """
+
+    extensions = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+    def __init__(self, output_folder: str, dataset_id: str, start_date: str, end_date: str, file_format: str = 'csv',
+                 partitioned: bool = False, kinds: dict = None, values_dtype: str = 'float64'):
+        self.output_folder = output_folder
+        self.dataset_id = dataset_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.file_format = file_format
+        self.partitioned = partitioned
+        self.kinds = kinds or {}
+        self.values_dtype = values_dtype
+        self.paths: list = []
+        self.__writer = None
+        self.__columns = None
+        self.__schema = None
+
+    def __path(self, start_date: str, end_date: str) -> str:
+        file_name = '_'.join([self.dataset_id, start_date, end_date]) + self.extensions[self.file_format]
+        return os.path.join(self.output_folder, file_name)
+
+    def write(self, buffers: _RecordBuffers, start_date: str, end_date: str) -> None:
+        """
+        Writes the records of a date range. The date ranges without records are not written.
+        """
+        if len(buffers) == 0:
+            return
+        if self.partitioned or not self.paths:
+            self.__close_writer()
+            self.paths.append(self.__path(start_date, end_date) if self.partitioned else
+                              self.__path(self.start_date, self.end_date))
+        if self.file_format == 'csv':
+            self.__write_csv(buffers.to_pandas(self.kinds, self.values_dtype))
+        else:
+            self.__write_arrow(buffers.to_arrow(self.kinds, self.values_dtype))
+
+    def __write_csv(self, frame: pd.DataFrame) -> None:
+        path = self.paths[-1]
+        if self.__columns is None:
+            self.__columns = list(frame.columns) + [name for name in self.kinds if name not in frame.columns]
+            frame.reindex(columns=self.__columns).to_csv(path, index=False)
+            return
+        new_columns = [name for name in frame.columns if name not in self.__columns]
+        if new_columns:
+            # Columnas que no estaban en los rangos anteriores, se reescribe el archivo con el nuevo encabezado
+            self.__columns = self.__columns + new_columns
+            old_path = f'{path}.{os.getpid()}.old'
+            os.replace(path, old_path)
+            parts = pd.read_csv(old_path, dtype=str, keep_default_na=False, chunksize=100000)
+            for number, part in enumerate(parts):
+                part.reindex(columns=self.__columns, fill_value='').to_csv(path, mode='a' if number else 'w',
+                                                                          header=not number, index=False)
+            os.remove(old_path)
+        frame.reindex(columns=self.__columns).to_csv(path, mode='a', header=False, index=False)
+
+    def __arrow_type(self, kind: str):
+        single_dictionary = self.file_format == 'feather' and not self.partitioned
+        return {'datetime': pyarrow.timestamp('ns'),
+                'float': pyarrow.from_numpy_dtype(np.dtype(self.values_dtype)),
+                'integer': pyarrow.int64(),
+                'category': pyarrow.string() if single_dictionary else pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+                'text': pyarrow.string()}.get(kind)
+
+    def __first_schema(self, schema):
+        """Schema of a new file: the columns of the first date range and of the metadata, typed by the metadata when empty"""
+        fields = [field.with_type(self.__arrow_type(self.kinds[field.name]))
+                  if pyarrow.types.is_null(field.type) and self.kinds.get(field.name) else field for field in schema]
+        fields += [pyarrow.field(name, self.__arrow_type(kind)) for name, kind in self.kinds.items()
+                   if name not in schema.names]
+        return pyarrow.schema(fields)
+
+    def __promote(self, schema):
+        """Schema of the file that also admits a new date range, the types that can not be promoted are kept as text"""
+        try:
+            return pyarrow.unify_schemas([self.__schema, schema], promote_options='permissive')
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+            types = dict(zip(schema.names, schema.types))
+            fields = [field if field.name not in types or types[field.name] == field.type or pyarrow.types.is_null(types[field.name])
+                      else field.with_type(pyarrow.string()) for field in self.__schema]
+            fields += [field for field in schema if field.name not in self.__schema.names]
+            return pyarrow.schema(fields)
+
+    @staticmethod
+    def __conform(table, schema):
+        return pyarrow.table([table.column(field.name).cast(field.type) if field.name in table.column_names
+                              else pyarrow.nulls(len(table), field.type) for field in schema], schema=schema)
+
+    def __open_writer(self, path: str, schema):
+        if self.file_format == 'parquet':
+            return pyarrow.parquet.ParquetWriter(path, schema)
+        options = pyarrow.ipc.IpcWriteOptions(compression='lz4' if pyarrow.Codec.is_available('lz4') else None)
+        return pyarrow.ipc.new_file(path, schema, options=options)
+
+    def __rewrite(self, schema) -> None:
+        """Rewrites the file written so far with a promoted schema, one batch at a time"""
+        path = self.paths[-1]
+        old_path = f'{path}.{os.getpid()}.old'
+        self.__writer.close()
+        os.replace(path, old_path)
+        self.__writer = self.__open_writer(path, schema)
+        if self.file_format == 'parquet':
+            file = pyarrow.parquet.ParquetFile(old_path)
+            for batch in file.iter_batches():
+                self.__writer.write_table(self.__conform(pyarrow.Table.from_batches([batch]), schema))
+            file.close()
+        else:
+            with pyarrow.memory_map(old_path) as source:
+                reader = pyarrow.ipc.open_file(source)
+                for number in range(reader.num_record_batches):
+                    batch = reader.get_batch(number)
+                    self.__writer.write_table(self.__conform(pyarrow.Table.from_batches([batch]), schema))
+        os.remove(old_path)
+        self.__schema = schema
+
+    def __write_arrow(self, table) -> None:
+        # Índices de las categorías de un mismo ancho, para que el esquema no cambie entre rangos. Un archivo
+        # Feather admite un solo diccionario por columna, si recibe varios rangos las categorías se guardan como texto
+        single_dictionary = self.file_format == 'feather' and not self.partitioned
+        table = table.cast(pyarrow.schema([
+            field.with_type(field.type.value_type if single_dictionary else
+                            pyarrow.dictionary(pyarrow.int32(), field.type.value_type))
+            if pyarrow.types.is_dictionary(field.type) else field for field in table.schema]))
+        if self.__writer is None:
+            self.__schema = self.__first_schema(table.schema)
+            self.__writer = self.__open_writer(self.paths[-1], self.__schema)
+        else:
+            schema = self.__promote(table.schema)
+            if not schema.equals(self.__schema):
+                self.__rewrite(schema)
+        self.__writer.write_table(self.__conform(table, self.__schema))
+
+    def __close_writer(self) -> None:
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__writer = None
+        self.__columns = None
+        self.__schema = None
+
+    def close(self) -> list:
+        """
+        Closes the last file and returns the paths of the files written.
+        """
+        self.__close_writer()
+        for path in self.paths:
+            print(f'{path} saved into {self.output_folder}')
+        logging.info("%s from %s to %s dataset saved in %d files.", self.dataset_id, self.start_date, self.end_date,
+                     len(self.paths))
+        return self.paths
+
+    def scan(self, output: str):
+        """
+        Returns a lazy handle to the files written: the list of paths for 'pandas', a pyarrow.dataset.Dataset
+        for 'arrow' and a polars.LazyFrame for 'polars'.
+        """
+        if output == 'arrow':
+            return pyarrow.dataset.dataset(self.paths, format=self.file_format)
+        if output == 'polars':
+            scan = {'csv': polars.scan_csv, 'parquet': polars.scan_parquet, 'feather': polars.scan_ipc}[self.file_format]
+            return scan(self.paths)
+        return list(self.paths)
+
+class _Checkpoint:
+    """
+    Directory where each date range of an extraction is saved as soon as it is received, so a failed
+    extraction can be run again without requesting the date ranges already received. Every date range
+    is saved in its own file and then registered in the journal (journal.jsonl) with the URL and filters
+    of its request, a date range without a journal entry is requested again.
+    """
+
+    journal_name = 'journal.jsonl'
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.journal_path = os.path.join(directory, self.journal_name)
+        self.__lock = threading.Lock()
+        self.__broken_line = False
+        self.entries: dict = self.__read_journal()
+
+    def __read_journal(self) -> dict:
+        entries = {}
+        if not os.path.exists(self.journal_path):
+            return entries
+        with open(self.journal_path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Última línea incompleta de una ejecución interrumpida
+                    self.__broken_line = not line.endswith('\n')
+                    continue
+                entries[entry['key']] = entry
+        return entries
+
+    @staticmethod
+    def key(url: str, filters: list = None) -> str:
+        """
+        Returns the key of the request of a date range, from its URL and filters.
+        """
+        request = json.dumps([url, filters], sort_keys=True, default=str)
+        return hashlib.sha1(request.encode('utf-8')).hexdigest()[:16]
+
+    def load(self, key: str) -> _RecordBuffers | None:
+        """
+        Returns the records saved for the key, None if the date range was not completed.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, entry['file']), 'rb') as file:
+                return pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            logging.warning("The checkpoint file %s can not be read, the date range will be requested again.", entry['file'])
+            return None
+
+    def save(self, key: str, url: str, buffers: _RecordBuffers) -> None:
+        """
+        Saves the records of a date range and registers them in the journal.
+        """
+        file_name = f'{key}.pkl'
+        path = os.path.join(self.directory, file_name)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump(buffers, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        entry = {'key': key, 'url': url, 'rows': len(buffers), 'file': file_name,
+                 'saved': dt.datetime.now().isoformat(timespec='seconds')}
+        with self.__lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as file:
+                file.write(('\n' if self.__broken_line else '') + json.dumps(entry) + '\n')
+                self.__broken_line = False
+                file.flush()
+                os.fsync(file.fileno())
+            self.entries[key] = entry
+
 @dataclass
 class ReadSIMEM:
     """
@@ -164,6 +744,8 @@ class ReadSIMEM:
         The granularity of the dataset.
     __resolution : int
         The resolution of the dataset.
+    __stats : dict
+        Requests made by the object with the bytes received on the wire and after decompressing them.
 
     Methods:
 
@@ -292,10 +874,10 @@ class ReadSIMEM:
         None
     
         """
-        with requests.Session() as session:
+        with self._new_session() as session:
             url = self.url_api if catalog else self.url_info_api
             url = url.format(reference_date, reference_date)
-            response = self._make_request(url, session, type = 'get')
+            response = self._make_request(url, session, type = 'get', stats=self.__get_stats())
             response["parameters"]["startDate"] = dt.datetime.strftime(self.get_startdate(), date_format)
             response["parameters"]["endDate"] = dt.datetime.strftime(self.get_enddate(), date_format)
             metadata = response["result"]["metadata"]
@@ -306,44 +888,126 @@ class ReadSIMEM:
             self.__resolution: int = self.__check_date_resolution(self.__granularity)
             session.close()
         
-    def main(self, output_folder : str = "", filter: bool = False) -> pd.DataFrame:
+    def main(self, output_folder : str = "", filter: bool = False, output: str = 'pandas', max_workers: int = max_workers,
+             typed: bool = True, values_dtype: str = 'float64', file_format: str = 'csv', partitioned: bool = False,
+             in_memory: bool = True, checkpoint_dir: str = None, max_retries: int = max_retries,
+             backoff_factor: float = backoff_factor):
         """
         Creates a dataframe with the information about the required dataset 
         in the given dates.
         
         Parameters:
-        data_format : str 
-            The format in which to return the data. Default is 'csv'.
-        save_file : bool
-            If True, the extracted data will be saved to a file. Default is False.
+        output_folder : str
+            If it is an existing folder, the data is written there in file_format while each date range
+            is received. Default is "", nothing is written.
         filter : bool
             If True, applies a filter to the data extraction process. Default is False.
+        output : str
+            'pandas' (pd.DataFrame), 'arrow' (pyarrow.Table) or 'polars' (polars.DataFrame). The Arrow
+            and Polars outputs are built column by column from the records, without a pandas DataFrame.
+        max_workers : int
+            Maximum number of date ranges requested at the same time. The records keep the order
+            of the date ranges. Default is 8, 1 requests them one after another.
+        typed : bool
+            If True, the columns are typed with the dataType of the column metadata (get_columns):
+            dates as datetime64, decimals as values_dtype, integers as int64 and the text columns of
+            codes (Codigo*) as category. If False, the columns keep the types of the JSON records.
+            Default is True.
+        values_dtype : str
+            The dtype of the decimal columns when typed is True, 'float64' (default) or 'float32'.
+        file_format : str
+            Format of the files of output_folder: 'csv' (default), 'parquet' or 'feather'.
+        partitioned : bool
+            If True, each requested date range is written to its own file (one month for hourly and 
+            daily datasets). Default is False, a single file.
+        in_memory : bool
+            If False, the data is only written to output_folder and a lazy handle to the files is 
+            returned instead of the data: the list of paths for 'pandas', a pyarrow.dataset.Dataset for
+            'arrow' and a polars.LazyFrame for 'polars'. Default is True.
+        checkpoint_dir : str
+            If given, each date range is saved in this folder as soon as it is received. Running main
+            again with the same dataset, dates and filters requests only the date ranges not saved, so a
+            failed extraction resumes where it stopped. The folder is kept after the extraction.
+        max_retries : int
+            Retries of a date range that fails with 429, 5xx or a connection error. Default is 3.
+        backoff_factor : float
+            Base seconds of the exponential backoff between retries. Default is 0.5.
         
         Returns:
         result: 
-            The extracted and formatted data.
-        """
+            The extracted and formatted data, or the handle to the files when in_memory is False.
+        """
+        output = _Validation.output(output)
+        values_dtype = _Validation.values_dtype(values_dtype)
+        file_format = _Validation.file_format(file_format)
+        if not in_memory and not os.path.exists(output_folder):
+            raise ValueError("in_memory=False requires an existing output_folder")
+        kinds = self._column_kinds() if typed else {}
         print('Inicio consulta sincronica') 
 
         t0 = time.time()
         resolution: int = self.get_resolution()
         self.__filter = filter
+        self.__max_retries = max_retries
+        self.__backoff_factor = backoff_factor
         urls: list[str] = self.__create_urls(self.get_startdate(), self.get_enddate(), resolution)
         t1 = time.time()
         print(f'Creacion url: {t1 - t0}')
 
-        with requests.Session() as session:
-            records = list(map(self._get_records, urls, repeat(session)))
-        
-        records = [item for sublist in records for item in sublist if len(sublist) != 0]
+        sink = None
+        if os.path.exists(output_folder):
+            print('The file will be saved with a default name.')
+            sink = _DatasetSink(output_folder, self.get_datasetid().upper(), str(self.get_startdate().date()),
+                                str(self.get_enddate().date()), file_format, partitioned, kinds, values_dtype)
+        date_ranges = list(zip(*self._generate_dates(self.get_startdate(), self.get_enddate(), resolution)))
+
+        checkpoint = _Checkpoint(checkpoint_dir) if checkpoint_dir is not None else None
+        filters = self.get_filters() if self.__get_filter_bool() else None
+        recovered = []
+        def fetch(url: str, session: requests.Session) -> _RecordBuffers:
+            if checkpoint is None:
+                return self._get_record_buffers(url, session)
+            key = checkpoint.key(url, filters)
+            chunk = checkpoint.load(key)
+            if chunk is not None:
+                recovered.append(url)
+                return chunk
+            chunk = self._get_record_buffers(url, session)
+            checkpoint.save(key, url, chunk)
+            return chunk
+
+        buffers = _RecordBuffers()
+        def store(chunk: _RecordBuffers, date_range: tuple):
+            if sink is not None:
+                sink.write(chunk, *date_range)
+            if in_memory:
+                buffers.extend(chunk)
+
+        workers = max(1, min(max_workers, len(urls)))
+        with self._new_session(workers) as session:
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for chunk, date_range in zip(executor.map(fetch, urls, repeat(session)), date_ranges):
+                        store(chunk, date_range)
+            else:
+                for chunk, date_range in zip(map(fetch, urls, repeat(session)), date_ranges):
+                    store(chunk, date_range)
+        if sink is not None:
+            sink.close()
+        if recovered:
+            print(f'{len(recovered)} of {len(urls)} date ranges recovered from the checkpoint {checkpoint_dir}')
 
         t2 = time.time()
         print(f'Extraccion de registros: {t2 - t1}')
 
-        result = pd.DataFrame.from_records(records)
-        if os.path.exists(output_folder):
-            new_file = self.__save_dataset(output_folder, result)
-            result = pd.read_csv(new_file)
+        if not in_memory and sink.paths:
+            result = sink.scan(output)
+        elif output == 'pandas':
+            result = buffers.to_pandas(kinds, values_dtype)
+        else:
+            result = buffers.to_arrow(kinds, values_dtype)
+            if output == 'polars':
+                result = polars.from_arrow(result)
         print('End of data extracting process')
         print('*' * 100)
         
@@ -366,7 +1030,7 @@ class ReadSIMEM:
             A list of records from the dataset.
         """
         records = self._make_request(url, session, type=type, filter=self.__get_filter_bool(), 
-                                     filters=self.get_filters())
+                                     filters=self.get_filters(), stats=self.__get_stats())
         if type == 'get':  
             result = records.get('result', {})
             records = result.get('records', [])
@@ -377,37 +1041,83 @@ class ReadSIMEM:
     
         return records
 
-    def __save_dataset(self, output_folder: str, result : pd.DataFrame | None = None) -> str:
+    def _get_record_buffers(self, url: str, session: requests.Session) -> _RecordBuffers:
         """
-        This method saves the dataset to a file with a default name that includes the dataset ID and the date range.
-        The file is saved in CSV format.
+        Makes the request of a date range and returns its records in column buffers.
         
         Parameters:
-            output_folder : str
-            The folder where the output file will be saved.
-
-        Returns:
-            str
-            The path to the saved file.
+        url : str
+            The URL for the dataset request.
+        session : requests.Session
+            The session for making the request.
         
+        Returns:
+        _RecordBuffers
+            The records of the date range.
+        """
+        retries = getattr(self, "_ReadSIMEM__max_retries", max_retries)
+        attempt = 0
+        while True:
+            try:
+                buffers = self._request_records(url, session, filter=self.__get_filter_bool(), 
+                                                filters=self.get_filters(), stats=self.__get_stats())
+                break
+            except requests.RequestException as error:
+                if attempt >= retries or not self._is_retryable(error):
+                    raise
+                delay = self._backoff(attempt, error, getattr(self, "_ReadSIMEM__backoff_factor", backoff_factor))
+                logging.warning("Retry %d of %d in %.1f seconds after: %s", attempt + 1, retries, delay, error)
+                with _stats_lock:
+                    self.__get_stats()['retries'] += 1
+                time.sleep(delay)
+                attempt += 1
+        if len(buffers) == 0:
+           print(f'For the URL: {url}') 
+           print('There are 0 records') 
+        logging.info("Records saved: %d rows registered.", len(buffers))
+
+        return buffers
+
+    @staticmethod
+    def _new_session(pool_size: int = 1) -> requests.Session:
         """
+        Creates a session that requests the responses compressed (gzip, deflate and br or zstd
+        when their decoders are installed). urllib3 decompresses them while they are read.
         
-        print('The file will be saved with a default name.')
-        datasetid = f'{self.get_datasetid().upper()}'
-        fechas = f'{self.get_startdate().date()}_{self.get_enddate().date()}'
-        file_name = '_'.join([datasetid, fechas])
-        file_name = os.path.join(output_folder, file_name + '.csv')
-        if result is not None:
-            result.to_csv(file_name, index=False)
-            print(f'{file_name} saved into {output_folder}')
-        else:
-            print(f'{file_name} not saved into {output_folder}')
-        logging.info("%s from %s to %s dataset saved.", self.get_datasetid(), self.get_startdate(), self.get_enddate())
-       
-        return file_name 
-    
+        Parameters:
+        pool_size : int
+            Number of connections kept open per host, one for each thread using the session.
+        
+        Returns:
+        requests.Session
+            The session for making requests to the API.
+        """
+        session = requests.Session()
+        session.headers['Accept-Encoding'] = accept_encoding
+        if pool_size > 1:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+    @staticmethod
+    def _record_stats(stats: dict, url: str, response: requests.Response, content_bytes: int, t0: float) -> None:
+        """
+        Registers a response in the statistics: its bytes after and before decompression and its time.
+        """
+        # tell() cuenta los bytes leídos de la red, antes de descomprimir
+        wire_bytes = response.raw.tell() if hasattr(response.raw, 'tell') else content_bytes
+        with _stats_lock:
+            stats['requests'] += 1
+            stats['bytes'] += content_bytes
+            stats['bytes_on_wire'] += wire_bytes
+            stats['records'].append({'url': url, 'status': response.status_code,
+                                     'encoding': response.headers.get('Content-Encoding', 'identity'),
+                                     'bytes': content_bytes, 'wire_bytes': wire_bytes, 'seconds': time.time() - t0})
+
     @staticmethod
-    def _make_request(url: str, session: requests.Session, type: str, filter: bool = False, filters: list = None) -> dict:
+    def _make_request(url: str, session: requests.Session, type: str, filter: bool = False, filters: list = None,
+                      stats: dict = None) -> dict:
         """
         Makes the GET request to the URL inside a session and delivers a dictionary
         with the response.
@@ -423,12 +1133,14 @@ class ReadSIMEM:
             If True, applies a filter to the data extraction process. Default is False.
         filters (Optional): list
             Filters for the data
+        stats (Optional): dict
+            Statistics where the bytes of the response are registered
         
         Returns:
         dict
             A dictionary containing the response in json encoded format.
         """
-        
+        t0 = time.time()
         if type == 'get':
             response = session.get(url)
         elif type == 'post' and filter:
@@ -439,6 +1151,9 @@ class ReadSIMEM:
         response.raise_for_status()
         data = response.json()
 
+        if stats is not None:
+            ReadSIMEM._record_stats(stats, url, response, len(response.content), t0)
+
         if type == 'get':
             status : str = data.get('success', False)
             api_params = data.get('parameters', None)
@@ -450,6 +1165,72 @@ class ReadSIMEM:
 
         return data
 
+    @staticmethod
+    def _is_retryable(error: requests.RequestException) -> bool:
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code in retry_status
+        return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                                  requests.exceptions.ContentDecodingError))
+
+    @staticmethod
+    def _backoff(attempt: int, error: requests.RequestException = None, backoff_factor: float = backoff_factor) -> float:
+        """
+        Seconds to wait before a retry, the Retry-After of the response when the server sends it.
+        """
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), max_backoff)
+        delay = min(max_backoff, backoff_factor * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def _request_records(url: str, session: requests.Session, filter: bool = False, filters: list = None,
+                         stats: dict = None) -> _RecordBuffers:
+        """
+        Makes the POST request of the data and appends the records to column buffers while the 
+        response is received, so the body and the records are never kept complete in memory.
+        
+        Parameters:
+        url : str
+            The URL for the dataset request.
+        session : requests.Session
+            The session for making the request.
+        filter : bool
+            If True, applies a filter to the data extraction process. Default is False.
+        filters (Optional): list
+            Filters for the data
+        stats (Optional): dict
+            Statistics where the bytes of the response are registered
+        
+        Returns:
+        _RecordBuffers
+            The records of the response.
+        """
+        t0 = time.time()
+        if filter:
+            response = session.post(url, json=filters, stream=True)
+        else:
+            response = session.post(url, stream=True)
+        logging.info("Response with status: %s", response.status_code)
+        response.raise_for_status()
+
+        buffers = _RecordBuffers()
+        sizes = []
+        def body():
+            for chunk in response.iter_content(read_chunk_size):
+                sizes.append(len(chunk))
+                yield chunk
+
+        with response:
+            for record in _iter_records(body()):
+                buffers.append(record)
+
+        if stats is not None:
+            ReadSIMEM._record_stats(stats, url, response, sum(sizes), t0)
+
+        return buffers
+
     @staticmethod
     def __check_date_resolution(granularity: str) -> int:
         """
@@ -593,6 +1374,33 @@ class ReadSIMEM:
             logging.info("No filter assigned.")
         return var_filters
 
+    def __get_stats(self) -> dict:
+        """
+        Returns the statistics of the requests of the object, creating them on the first request.
+        
+        Returns:
+        dict
+            The statistics of the requests.
+        """
+        var_stats = getattr(self, "_ReadSIMEM__stats", None)
+        if var_stats is None:
+            var_stats = {'requests': 0, 'retries': 0, 'bytes': 0, 'bytes_on_wire': 0, 'records': []}
+            self.__stats = var_stats
+        return var_stats
+
+    def get_stats(self) -> dict:
+        """
+        Returns the requests made by the object with the bytes received.
+        
+        Returns:
+        dict
+            'requests', 'retries', 'bytes' (decompressed), 'bytes_on_wire' (as received), 'compression_ratio'
+            and 'records' with the url, status, encoding, bytes, wire_bytes and seconds of each request.
+        """
+        var_stats = self.__get_stats()
+        ratio = var_stats['bytes'] / var_stats['bytes_on_wire'] if var_stats['bytes_on_wire'] else None
+        return dict(var_stats, records=list(var_stats['records']), compression_ratio=ratio)
+
     def get_resolution(self) -> int:
         """
         Returns the resolution of the dataset object.
@@ -633,6 +1441,25 @@ class ReadSIMEM:
         """
         return self.__columns  
 
+    def _column_kinds(self) -> dict:
+        """
+        Returns the kind of each column of the dataset from the dataType of the column metadata.
+        
+        Returns:
+        dict
+            The name of the column and its kind ('datetime', 'float', 'integer', 'category' or 'text').
+        """
+        columns = getattr(self, "_ReadSIMEM__columns", None)
+        if columns is None or columns.empty:
+            return {}
+        name_key = next((key for key in ('nameColumn', 'name', 'columnName') if key in columns), None)
+        type_key = next((key for key in ('dataType', 'type', 'tipoDato') if key in columns), None)
+        if name_key is None or type_key is None:
+            logging.info("The column metadata has no data types, the columns will not be typed.")
+            return {}
+        kinds = {name: _column_kind(name, data_type) for name, data_type in zip(columns[name_key], columns[type_key])}
+        return {name: kind for name, kind in kinds.items() if kind is not None}
+
     def get_name(self) -> str:
         """
         Returns the name of the dataset.
@@ -670,7 +1497,7 @@ class CatalogSIMEM(ReadSIMEM):
 
         self._set_dataset_data(catalog=True)
         self.url_api = self.url_api.format(self.get_startdate(), self.get_enddate())
-        with requests.Session() as session:
+        with self._new_session() as session:
             datasets = super()._get_records(self.url_api, session, type='get')
             self.__data = pd.DataFrame.from_records(datasets)
         logging.info("Catalog retrieved correctly.")
@@ -827,7 +1654,7 @@ class VariableSIMEM:
             self.__granularity = dataset.get_granularity()
             check_filter = True
 
-        data = dataset.main(filter = check_filter)
+        data = dataset.main(filter = check_filter, typed=False)
         self._data = _Validation.dataset(data, start_date, end_date)
         return self._data
 
@@ -1169,7 +1996,7 @@ class VariableSIMEM:
 
         first_day_of_month = pd.to_datetime(month)
         last_day_of_month = first_day_of_month + pd.offsets.MonthEnd(0)
-        daily_df = ReadSIMEM(daily_dataset_id, first_day_of_month.strftime("%Y-%m-%d"), last_day_of_month.strftime("%Y-%m-%d")).main()
+        daily_df = ReadSIMEM(daily_dataset_id, first_day_of_month.strftime("%Y-%m-%d"), last_day_of_month.strftime("%Y-%m-%d")).main(typed=False)
         daily_df = VariableSIMEM._order_date(dataset=daily_df, date_column='FechaPublicacion')
 
         return daily_df
@@ -1202,7 +2029,7 @@ class VariableSIMEM:
         if cache_key in VariableSIMEM._cache:
                     df_filtered = VariableSIMEM._cache[cache_key]
         else:
-            version_df = ReadSIMEM(dataset_id, first_day, end_date).main()
+            version_df = ReadSIMEM(dataset_id, first_day, end_date).main(typed=False)
             version_df = VariableSIMEM._validate_version_df(version_df=version_df, first_date=first_day)
             df_sorted = VariableSIMEM._order_date(dataset=version_df, date_column='FechaPublicacion')
             
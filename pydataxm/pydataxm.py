@@ -5,28 +5,500 @@ Created on Tue Apr 12 11:05:46 2022
 @author: 1040750676
 """
 
+import os
+import time
+import hashlib
+import random
 import requests
 import json
+import re
+import zlib
+import numpy as np
 import pandas as pd
 import datetime as dt
+from dataclasses import dataclass, field
 #noinspection SpellCheckingInspection
 import aiohttp # es para hacer peticiones asincronas
 import asyncio # es para hacer peticiones asincronas
+import threading
+import weakref
+from collections import OrderedDict
 import warnings
 warnings.filterwarnings("ignore")
-import nest_asyncio
-nest_asyncio.apply()
+try:
+    import pyarrow # formato parquet para el almacenamiento local de periodos
+except ImportError:
+    pyarrow = None
+try:
+    import polars # salida output='polars'
+except ImportError:
+    polars = None
+try:
+    import orjson # decodificación rápida de las respuestas JSON
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+try:
+    import brotli # respuestas comprimidas con Content-Encoding: br
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+api_url = 'https://servapibi.xm.com.co'
+inventory_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pydataxm')
+inventory_file = 'inventario_metricas.pkl'
+schema_file = 'esquemas_metricas.json'
+inventory_ttl = 24 * 60 * 60  # segundos
+limit_per_host = 8
+ttl_dns_cache = 300  # segundos
+keepalive_timeout = 60  # segundos
+max_concurrency = 8
+max_retries = 3
+backoff_factor = 0.5  # segundos
+max_backoff = 30  # segundos
+request_timeout = 300  # segundos
+retry_status = (429, 500, 502, 503, 504)
+# Caches del proceso por (base_url, ruta del archivo), la ruta es None cuando no hay cache en disco
+_inventory_cache: dict = {}
+_schema_cache: dict = {}
+settlement_months = 1
+memory_cache_ttl = 60  # segundos
+accept_encoding = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+read_chunk_size = 2 ** 16  # bytes
+outputs = ('pandas', 'arrow', 'polars')
+hour_column = re.compile(r'^Values_Hour(\d{2})$')
+period_dict = {
+    'HourlyEntities': {'period_base': 'hourly', 'delta': 30, 'endpoint': 'HourlyEntities', 'period': 'M'},
+    'DailyEntities': {'period_base': 'daily', 'delta': 30, 'endpoint': 'DailyEntities', 'period': 'M'},
+    'MonthlyEntities': {'period_base': 'monthly', 'delta': 732, 'endpoint': 'MonthlyEntities', 'period': 'M'},
+    'AnnualEntities': {'period_base': 'annual', 'delta': 366, 'endpoint': 'AnnualEntities', 'period': 'Y'}
+}
+
+@dataclass
+class RequestPlan:
+    """
+    Plan of the requests of a ReadDB.request_data call
+
+    Attributes:
+    coleccion : str
+        MetricId of the request.
+    metrica : str
+        Entity of the request.
+    entity_type : str
+        Type of the entity in the inventory (HourlyEntities, DailyEntities, ...).
+    url : str
+        URL of the API XM service.
+    ranges : list
+        (StartDate, EndDate) of each request to the API.
+    local_ranges : list
+        (StartDate, EndDate) of the periods read from the local store.
+    """
+    coleccion: str
+    metrica: str
+    entity_type: str
+    url: str
+    ranges: list
+    local_ranges: list
+
+    @property
+    def n_requests(self) -> int:
+        """Number of requests to the API"""
+        return len(self.ranges)
+
+@dataclass
+class RequestStats:
+    """
+    Instrumentation of the requests of a ReadDB client, enabled with ReadDB(stats=True)
+
+    Attributes:
+    phases : dict
+        Seconds spent in each phase: plan, queue, network, decode, normalize, concat, coerce and reshape.
+        The phases of the chunks are summed over all the chunks, so they can exceed the wall time.
+    chunks : list
+        One record per request to the API with url, endpoint, StartDate, EndDate, status, retries, bytes
+        (decompressed), wire_bytes (as received, compressed), error and the seconds of queue, network, decode and normalize.
+    requests : int
+        Number of requests to the API, without retries.
+    retries : int
+        Number of retried requests.
+    bytes_received : int
+        Bytes of the bodies of the responses after decompressing them.
+    bytes_on_wire : int
+        Bytes of the bodies of the responses as received, before decompressing them.
+    status_codes : dict
+        Number of responses per HTTP status, including the retried ones.
+    cache_hits : int
+        Requests answered by the memory cache.
+    callback : callable
+        Optional function called with each chunk record as soon as the chunk finishes.
+    """
+    phases: dict = field(default_factory=dict)
+    chunks: list = field(default_factory=list)
+    requests: int = 0
+    retries: int = 0
+    bytes_received: int = 0
+    bytes_on_wire: int = 0
+    status_codes: dict = field(default_factory=dict)
+    cache_hits: int = 0
+    callback: object = None
+    _lock: object = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add_phase(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_status(self, status):
+        with self._lock:
+            self.status_codes[status] = self.status_codes.get(status, 0) + 1
+
+    def add_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def add_chunk(self, record: dict):
+        with self._lock:
+            self.chunks.append(record)
+            self.requests += 1
+            self.retries += record['retries']
+            self.bytes_received += record['bytes']
+            self.bytes_on_wire += record['wire_bytes']
+            for phase in ('queue', 'network', 'decode', 'normalize'):
+                self.phases[phase] = self.phases.get(phase, 0.0) + record[phase]
+        if self.callback is not None:
+            self.callback(record)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Chunk records as a DataFrame, e.g. to find the slowest periods or endpoints"""
+        with self._lock:
+            return pd.DataFrame(self.chunks)
+
+class _DeflateDecompressor:
+    """Decompressor of Content-Encoding: deflate, with or without the zlib header"""
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, chunk: bytes) -> bytes:
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            try:
+                return self._decompressor.decompress(chunk)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(chunk)
+
+    def flush(self) -> bytes:
+        return self._decompressor.flush() if self._decompressor is not None else b''
+
+class _BrotliDecompressor:
+    """Decompressor of Content-Encoding: br with the interface of zlib"""
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+        self._process = getattr(self._decompressor, 'process', None) or self._decompressor.decompress
+
+    def decompress(self, chunk: bytes) -> bytes:
+        return self._process(chunk)
+
+    def flush(self) -> bytes:
+        return b''
+
+def _decompressor(encoding: str):
+    """Streaming decompressor of a Content-Encoding, None if it is not supported"""
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return _DeflateDecompressor()
+    if encoding == 'br' and brotli is not None:
+        return _BrotliDecompressor()
+    return None
+
+_end_of_iteration = object()
+_schema_lock = threading.RLock()
+
+async def _anext(iterator):
+    """Devuelve el siguiente elemento del generador asíncrono o _end_of_iteration cuando termina"""
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return _end_of_iteration
+
+def _stop_loop(loop, thread, sessions):
+    """Cierra la sesión del event loop de los métodos sincrónicos y detiene el hilo que lo ejecuta"""
+    if loop.is_closed():
+        return
+    session = sessions.pop(loop, None)
+    try:
+        if session is not None and not session.closed and loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+    except Exception:
+        pass
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    if not loop.is_running():
+        loop.close()
 
 class ReadDB(object):
-    def __new__(cls):
+    def __new__(cls, *args, **kwargs):
         return super(ReadDB, cls).__new__(cls)
     
-    def __init__(self):
-        """This object was created to extract data from API XM"""   
-        self.url = "https://servapibi.xm.com.co/{period_base}"
-        self.connection = None
-        self.request = ''
-        self.inventario_metricas = self.all_variables()
+    def __init__(self, cache_dir: str | None = inventory_cache_dir, inventory_ttl: float = inventory_ttl,
+                 limit_per_host: int = limit_per_host, ttl_dns_cache: int = ttl_dns_cache,
+                 max_concurrency: int = max_concurrency, max_retries: int = max_retries,
+                 backoff_factor: float = backoff_factor, request_timeout: float = request_timeout,
+                 store_dir: str | None = None, settlement_months: int = settlement_months,
+                 fast_json: bool = True, memory_cache_size: int = 0, memory_cache_ttl: float = memory_cache_ttl,
+                 filter_batch_size: int | None = None, stats: bool = False, stats_callback=None,
+                 base_url: str = api_url, compression: bool = True):
+        """This object was created to extract data from API XM
+
+        Args:
+            cache_dir: optional parameter, folder where the metric inventory is cached on disk. None disables the disk cache
+            inventory_ttl: optional parameter, seconds the cached inventory is considered valid. 0 forces a download
+            limit_per_host: optional parameter, maximum number of simultaneous connections to the API XM
+            ttl_dns_cache: optional parameter, seconds the resolved addresses of the API XM are reused
+            max_concurrency: optional parameter, maximum number of requests in flight for a query
+            max_retries: optional parameter, retries for a period that fails with 429, 5xx or a timeout
+            backoff_factor: optional parameter, base seconds of the exponential backoff between retries
+            request_timeout: optional parameter, maximum seconds for a single request
+            store_dir: optional parameter, folder of the local store of closed months (years for annual entities).
+                       None disables the store
+            settlement_months: optional parameter, months before the current one that are still downloaded every time
+            fast_json: optional parameter, if True the responses are decoded with orjson (when installed) and converted
+                       to columns directly instead of using pd.json_normalize
+            memory_cache_size: optional parameter, number of responses kept in memory to answer repeated requests. 0 disables it
+            memory_cache_ttl: optional parameter, seconds a response is kept in the memory cache
+            filter_batch_size: optional parameter, maximum number of filter values per request. Longer filter lists are
+                               split in batches that are requested in parallel with the periods. None disables it
+            stats: optional parameter, if True the client records timings per phase and per chunk, bytes, retries
+                   and status codes in self.stats (see RequestStats)
+            stats_callback: optional parameter, function called with the record of each chunk. It enables stats
+            base_url: optional parameter, root URL of the API XM, e.g. the URL of a pydataxm.replay.ReplayServer
+            compression: optional parameter, if True the responses are requested compressed (gzip, deflate and br when
+                         brotli is installed) and decompressed while they are received
+        """   
+        self.base_url = base_url.rstrip('/')
+        self.url = self.base_url + "/{period_base}"
+        self.compression = compression
+        self.cache_dir = cache_dir
+        self.inventory_ttl = inventory_ttl
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.request_timeout = request_timeout
+        self.store_dir = store_dir
+        self.settlement_months = settlement_months
+        self.fast_json = fast_json
+        self.memory_cache_size = memory_cache_size
+        self.memory_cache_ttl = memory_cache_ttl
+        self.filter_batch_size = filter_batch_size
+        self.stats = RequestStats(callback=stats_callback) if stats or stats_callback is not None else None
+        self._memory_cache = OrderedDict()
+        self._memory_cache_lock = threading.Lock()
+        self._inflight = {}
+        self._inventario_metricas = None
+        self._inventory_index = None
+        self._inventory_lock = threading.Lock()
+        self._sessions = {}
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+
+    async def __aenter__(self):
+        await self.get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+            Devuelve la sesión aiohttp del objeto para el event loop actual, creándola si no existe.
+            La sesión mantiene las conexiones abiertas (keep-alive) y las reutiliza entre solicitudes.
+
+            Returns:
+                aiohttp.ClientSession: La sesión compartida por todas las solicitudes del objeto en el event loop.
+        """
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            for other_loop in [x for x in list(self._sessions) if x.is_closed()]:
+                del self._sessions[other_loop]
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host,
+                                             ttl_dns_cache=self.ttl_dns_cache,
+                                             keepalive_timeout=keepalive_timeout)
+            timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+            headers = {'Accept-Encoding': accept_encoding if self.compression else 'identity'}
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers, auto_decompress=False)
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        """Cierra la sesión aiohttp del event loop actual y libera las conexiones abiertas."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def shutdown(self):
+        """Cierra la sesión de los métodos sincrónicos y detiene su event loop."""
+        with self._loop_lock:
+            if self._loop is not None:
+                self._finalizer()
+            self._loop = None
+            self._loop_thread = None
+
+    def _run(self, coroutine):
+        """Ejecuta la corrutina en el event loop del objeto, en un hilo propio, y espera su resultado"""
+        with self._loop_lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name='pydataxm', daemon=True)
+                self._loop_thread.start()
+                self._finalizer = weakref.finalize(self, _stop_loop, self._loop, self._loop_thread, self._sessions)
+            loop, loop_thread = self._loop, self._loop_thread
+        if threading.current_thread() is loop_thread:
+            coroutine.close()
+            raise RuntimeError('Use the async methods of ReadDB inside its own event loop')
+        future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    @property
+    def inventario_metricas(self) -> pd.DataFrame:
+        """Metric inventory of the API XM, loaded on first access from the cache or the API"""
+        inventory = self._inventario_metricas
+        if inventory is None:
+            # Un solo hilo descarga el inventario, los demás esperan y reutilizan el resultado
+            with self._inventory_lock:
+                if self._inventario_metricas is None:
+                    self._inventario_metricas = self._load_inventory()
+                inventory = self._inventario_metricas
+        return inventory
+
+    @inventario_metricas.setter
+    def inventario_metricas(self, value: pd.DataFrame):
+        self._inventario_metricas = value
+
+    def inventory_index(self) -> dict:
+        """ Returns the hash index of the metric inventory, rebuilt only when the inventory changes
+        Returns: 
+            dict with 'pairs': {(MetricId, Entity): row of the inventory as dict} and 'metrics': {MetricId: index labels}
+        """
+        inventory = self.inventario_metricas
+        index = self._inventory_index
+        if index is None or index['source'] is not inventory:
+            pairs = {}
+            metrics = {}
+            for label, row in zip(inventory.index, inventory.to_dict('records')):
+                pairs.setdefault((row.get('MetricId'), row.get('Entity')), row)
+                metrics.setdefault(row.get('MetricId'), []).append(label)
+            index = {'source': inventory, 'pairs': pairs, 'metrics': metrics}
+            self._inventory_index = index
+        return index
+
+    def _cache_path(self, name) -> str | None:
+        """Path of a cache file. The caches of other servers (e.g. a replay server) are kept in their own folder"""
+        if self.cache_dir is None:
+            return None
+        if self.base_url == api_url:
+            return os.path.join(self.cache_dir, name)
+        return os.path.join(self.cache_dir, hashlib.sha1(self.base_url.encode('utf-8')).hexdigest()[:12], name)
+
+    def _inventory_path(self) -> str | None:
+        return self._cache_path(inventory_file)
+
+    def _load_inventory(self) -> pd.DataFrame:
+        """Returns the metric inventory from the in-process cache, the disk cache or the API, in that order"""
+        path = self._inventory_path()
+        cached = _inventory_cache.get((self.base_url, path))
+        if cached is not None and time.time() - cached['timestamp'] < self.inventory_ttl:
+            return cached['data']
+
+        if path is not None and os.path.exists(path):
+            timestamp = os.path.getmtime(path)
+            if time.time() - timestamp < self.inventory_ttl:
+                try:
+                    df_variables = pd.read_pickle(path)
+                    _inventory_cache[(self.base_url, path)] = {'data': df_variables, 'timestamp': timestamp}
+                    return df_variables
+                except Exception:
+                    print('No fue posible leer el inventario en cache {}'.format(path))
+
+        return self.refresh_inventory()
+
+    def refresh_inventory(self) -> pd.DataFrame:
+        """This method downloads the metric inventory again and updates the caches.
+        Args:
+            None
+        Returns: 
+            Data Frame with all variables available into the API XM 
+        """
+        df_variables = self.all_variables()
+        path = self._inventory_path()
+        if path is not None:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+                df_variables.to_pickle(temp_path)
+                os.replace(temp_path, path)
+            except OSError:
+                print('No fue posible guardar el inventario en cache {}'.format(path))
+        _inventory_cache[(self.base_url, path)] = {'data': df_variables, 'timestamp': time.time()}
+        self._inventario_metricas = df_variables
+        self._save_schemas({})
+        return df_variables
+
+    def _schema_path(self) -> str | None:
+        return self._cache_path(schema_file)
+
+    def _schemas(self) -> dict:
+        """Returns the column schemas {'MetricId/Entity': schema} inferred in previous requests"""
+        path = self._schema_path()
+        schemas = _schema_cache.get((self.base_url, path))
+        if schemas is None:
+            schemas = {}
+            if path is not None and os.path.exists(path):
+                try:
+                    with open(path, encoding='utf-8') as file:
+                        schemas = json.load(file)
+                except (OSError, ValueError):
+                    print('No fue posible leer los esquemas en cache {}'.format(path))
+            _schema_cache[(self.base_url, path)] = schemas
+        return schemas
+
+    def _save_schemas(self, schemas: dict):
+        path = self._schema_path()
+        with _schema_lock:
+            _schema_cache[(self.base_url, path)] = schemas
+            if path is None:
+                return
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    json.dump(schemas, file)
+                os.replace(temp_path, path)
+            except OSError:
+                print('No fue posible guardar los esquemas en cache {}'.format(path))
+
+    def _update_schema(self, key: str, schema: dict):
+        """Adds the schema of one metric to the cache without losing the ones saved by other threads"""
+        with _schema_lock:
+            schemas = dict(self._schemas())
+            schemas[key] = schema
+            self._save_schemas(schemas)
         
     def all_variables(self):
         """This method allows the user to get all variables availables into the API XM.
@@ -36,7 +508,18 @@ class ReadDB(object):
             Data Frame with all variables available into the API XM 
         """
         request = {"MetricId": 'ListadoMetricas'}
-        connection = requests.post(f'https://servapibi.xm.com.co/Lists', json=request)
+        # Misma política de reintentos que los periodos: 429, 5xx, errores de conexión y timeouts
+        attempt = 0
+        while True:
+            try:
+                connection = requests.post(f'{self.base_url}/Lists', json=request, timeout=self.request_timeout)
+                connection.raise_for_status()
+                break
+            except requests.RequestException as error:
+                if attempt >= self.max_retries or not self._is_retryable(error):
+                    raise
+                time.sleep(self._backoff(attempt, error))
+                attempt += 1
         data_json = json.loads(connection.content)
         df_variables = pd.json_normalize(data_json['Items'], 'ListEntities', 'Date', sep='_')
         df_variables.drop(columns=['Id', 'Date'], inplace=True)
@@ -55,56 +538,340 @@ class ReadDB(object):
             if coleccion == '':
                 return self.inventario_metricas
             else:
-                return self.inventario_metricas.query("MetricId == '{}'".format(coleccion))
+                labels = self.inventory_index()['metrics'].get(coleccion)
+                if labels is None:
+                    return self.inventario_metricas.iloc[0:0]
+                return self.inventario_metricas.loc[labels]
         except:
             print('No existe la métrica {}'.format(coleccion))
             return pd.DataFrame()
     
-    async def async_get_df(self, body, endpoint):
+    async def async_get_df(self, body, endpoint, semaphore=None, url=None):
         """
             Realiza una solicitud HTTP POST asíncrona, obtiene la respuesta en formato JSON,
             la normaliza en un DataFrame de pandas y la devuelve.
+            Las solicitudes idénticas que están en curso en el mismo event loop comparten una sola
+            solicitud a la API y, si el caché en memoria está activo, las repetidas se responden desde él.
 
             Args:
                 body (dict): Un diccionario que contiene los datos que se enviarán en el cuerpo de la solicitud POST.
                 endpoint (str): Una cadena que especifica el nombre del endpoint que se utilizará para normalizar los datos JSON en un DataFrame.
+                semaphore (asyncio.Semaphore): Opcional, limita el número de solicitudes simultáneas.
+                url (str): Opcional, URL del servicio. Por defecto la del endpoint en self.url.
 
             Returns:
                 pd.DataFrame: Un DataFrame de pandas que contiene los datos normalizados obtenidos de la respuesta JSON.
         """
-        
-        async with aiohttp.ClientSession() as session:            
-               
-            async with session.post(self.url, json=body, headers={'Connection':'close'}) as response:                    
-                load = await response.json()
-                dataframe = pd.json_normalize(load['Items'], endpoint, 'Date', sep='_')
+        url = url or self._endpoint_url(endpoint)
+        key = (url, endpoint, json.dumps(body, sort_keys=True, default=str))
+        dataframe = self._memory_cache_get(key)
+        if dataframe is not None:
+            if self.stats is not None:
+                self.stats.add_cache_hit()
+            return dataframe
+
+        loop_key = (asyncio.get_running_loop(), key)
+        entry = self._inflight.get(loop_key)
+        leader = entry is None
+        if leader:
+            task = asyncio.ensure_future(self._fetch_df(body, endpoint, semaphore, url))
+            entry = {'task': task, 'waiters': 0}
+            self._inflight[loop_key] = entry
+            task.add_done_callback(lambda _: self._inflight.pop(loop_key, None) if self._inflight.get(loop_key) is entry else None)
+
+        entry['waiters'] += 1
+        try:
+            dataframe = await asyncio.shield(entry['task'])
+        except asyncio.CancelledError:
+            # Solo se cancela la solicitud compartida cuando nadie más la espera
+            if entry['waiters'] == 1:
+                entry['task'].cancel()
+            raise
+        finally:
+            entry['waiters'] -= 1
+
+        if leader:
+            self._memory_cache_put(key, dataframe)
+            return dataframe
+        return dataframe.copy()
+
+    async def _fetch_df(self, body, endpoint, semaphore, url):
+        """Solicitud a la API con reintentos: las respuestas 429, 5xx y los timeouts se reintentan con backoff exponencial y jitter"""
+        session = await self.get_session()
+        record = None
+        if self.stats is not None:
+            record = {'url': url, 'endpoint': endpoint, 'StartDate': body.get('StartDate'), 'EndDate': body.get('EndDate'),
+                      'status': None, 'retries': 0, 'bytes': 0, 'wire_bytes': 0, 'error': None,
+                      'queue': 0.0, 'network': 0.0, 'decode': 0.0, 'normalize': 0.0}
+        attempt = 0
+        while True:
+            try:
+                if semaphore is None:
+                    load = await self._post_json(session, url, body, record)
+                else:
+                    start = time.perf_counter() if record is not None else None
+                    async with semaphore:
+                        if record is not None:
+                            record['queue'] += time.perf_counter() - start
+                        load = await self._post_json(session, url, body, record)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if attempt >= self.max_retries or not self._is_retryable(error):
+                    if record is not None:
+                        record['error'] = repr(error)
+                        self.stats.add_chunk(record)
+                    raise
+                await asyncio.sleep(self._backoff(attempt, error))
+                attempt += 1
+                if record is not None:
+                    record['retries'] = attempt
+        start = time.perf_counter() if record is not None else None
+        if self.fast_json:
+            dataframe = self._normalize(load['Items'], endpoint)
+        else:
+            dataframe = pd.json_normalize(load['Items'], endpoint, 'Date', sep='_')
+        if record is not None:
+            record['normalize'] = time.perf_counter() - start
+            self.stats.add_chunk(record)
                 
         return dataframe
+
+    def _memory_cache_get(self, key) -> pd.DataFrame | None:
+        if self.memory_cache_size <= 0:
+            return None
+        with self._memory_cache_lock:
+            item = self._memory_cache.get(key)
+            if item is None:
+                return None
+            timestamp, dataframe = item
+            if time.monotonic() - timestamp > self.memory_cache_ttl:
+                del self._memory_cache[key]
+                return None
+            self._memory_cache.move_to_end(key)
+        return dataframe.copy()
+
+    def _memory_cache_put(self, key, dataframe: pd.DataFrame):
+        if self.memory_cache_size <= 0:
+            return
+        with self._memory_cache_lock:
+            self._memory_cache[key] = (time.monotonic(), dataframe.copy())
+            self._memory_cache.move_to_end(key)
+            while len(self._memory_cache) > self.memory_cache_size:
+                self._memory_cache.popitem(last=False)
+
+    async def _post_json(self, session, url, body, record=None):
+        start = time.perf_counter() if record is not None else None
+        try:
+            async with session.post(url, json=body) as response:
+                if record is not None:
+                    record['status'] = response.status
+                    self.stats.add_status(response.status)
+                response.raise_for_status()
+                content, wire_bytes = await self._read_body(response)
+        finally:
+            if record is not None:
+                record['network'] += time.perf_counter() - start
+        if record is None:
+            return json_loads(content) if self.fast_json else json.loads(content)
+
+        # Con estadísticas se separa el tiempo de red del de decodificación
+        record['bytes'] += len(content)
+        record['wire_bytes'] += wire_bytes
+        start = time.perf_counter()
+        load = json_loads(content) if self.fast_json else json.loads(content)
+        record['decode'] += time.perf_counter() - start
+        return load
+
+    @staticmethod
+    async def _read_body(response: aiohttp.ClientResponse) -> tuple:
+        """
+            Lee el cuerpo de la respuesta y lo descomprime por bloques a medida que llega.
+
+            Returns:
+                tuple: (bytes descomprimidos, número de bytes recibidos por la red)
+        """
+        encoding = response.headers.get('Content-Encoding', '').strip().lower()
+        if encoding in ('', 'identity'):
+            content = await response.read()
+            return content, len(content)
+        decompressor = _decompressor(encoding)
+        if decompressor is None:
+            raise ValueError('Content-Encoding no soportado: {}'.format(encoding))
+        parts = []
+        wire_bytes = 0
+        async for chunk in response.content.iter_chunked(read_chunk_size):
+            wire_bytes += len(chunk)
+            parts.append(decompressor.decompress(chunk))
+        parts.append(decompressor.flush())
+        return b''.join(parts), wire_bytes
+
+    @staticmethod
+    def _normalize(items, endpoint) -> pd.DataFrame:
+        """
+            Construye directamente las columnas de Items[*].<endpoint>[*] con el mismo resultado que
+            pd.json_normalize(items, endpoint, 'Date', sep='_'), sin aplanar cada registro por separado.
+            Si la estructura no es la esperada se usa pd.json_normalize.
+
+            Args:
+                items (list): La lista Items de la respuesta de la API.
+                endpoint (str): El nombre de la lista de registros dentro de cada item.
+
+            Returns:
+                pd.DataFrame: Un DataFrame con una columna por campo de los registros y la columna Date.
+        """
+        columns = {}
+        dates = []
+        n_rows = 0
+        for item in items:
+            records = item.get(endpoint)
+            if not isinstance(records, list):
+                return pd.json_normalize(items, endpoint, 'Date', sep='_')
+            for record in records:
+                if not isinstance(record, dict):
+                    return pd.json_normalize(items, endpoint, 'Date', sep='_')
+                n_values = 0
+                for key, value in record.items():
+                    if isinstance(value, dict):
+                        if not value:
+                            return pd.json_normalize(items, endpoint, 'Date', sep='_')
+                        for sub_key, sub_value in value.items():
+                            if isinstance(sub_value, dict):
+                                return pd.json_normalize(items, endpoint, 'Date', sep='_')
+                            column = columns.get(key + '_' + sub_key)
+                            if column is None:
+                                column = columns[key + '_' + sub_key] = [np.nan] * n_rows
+                            column.append(sub_value)
+                            n_values += 1
+                    else:
+                        column = columns.get(key)
+                        if column is None:
+                            column = columns[key] = [np.nan] * n_rows
+                        column.append(value)
+                        n_values += 1
+                n_rows += 1
+                if n_values != len(columns):
+                    for column in columns.values():
+                        if len(column) < n_rows:
+                            column.append(np.nan)
+            dates.append((item.get('Date'), len(records)))
+
+        if n_rows == 0 or 'Date' in columns:
+            return pd.json_normalize(items, endpoint, 'Date', sep='_')
+
+        dataframe = pd.DataFrame(columns)
+        dataframe['Date'] = np.array([date for date, _ in dates], dtype=object).repeat([length for _, length in dates])
+        return dataframe
+
+    @staticmethod
+    def _is_retryable(error) -> bool:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status in retry_status
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code in retry_status
+        return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError,
+                                  requests.ConnectionError, requests.Timeout))
+
+    def _backoff(self, attempt, error=None) -> float:
+        """Segundos de espera antes del reintento, respetando Retry-After cuando el servidor lo envía"""
+        response = getattr(error, 'response', None)
+        headers = getattr(error, 'headers', None) or getattr(response, 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), max_backoff)
+        delay = min(max_backoff, self.backoff_factor * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
         
-    async def run_async(self, list_bodies, endpoint):
+    async def run_async(self, list_bodies, endpoint, partial=False):
         """
             Coordina la ejecución de múltiples tareas asíncronas que llaman a async_get_df.
-            Recibe una lista de cuerpos de solicitudes, ejecuta todas las solicitudes en paralelo
-            y concatena los resultados en un único DataFrame.
+            Recibe una lista de cuerpos de solicitudes, ejecuta las solicitudes en paralelo
+            con un máximo de self.max_concurrency simultáneas y concatena los resultados en un único DataFrame.
+            Los cuerpos se ejecutan como los bloques de una sola solicitud de run_many, sin formatear los datos.
 
             Args:
                 list_bodies (list): Una lista de diccionarios, donde cada diccionario contiene los datos que se enviarán en el cuerpo de una solicitud POST.
                 endpoint (str): Una cadena que especifica el nombre del endpoint que se utilizará para normalizar los datos JSON en un DataFrame.
+                partial (bool): Si es True, los periodos que fallan no interrumpen la consulta y se devuelven aparte.
 
             Returns:
                 pd.DataFrame: Un DataFrame de pandas que contiene los datos concatenados de todas las respuestas JSON normalizadas.
+                Si partial es True devuelve la tupla (DataFrame, lista de periodos (StartDate, EndDate) fallidos).
         """
          
-        tasks = [self.async_get_df(body, endpoint) for body in list_bodies]
-        result =  await asyncio.gather(*tasks)
-        
-        df = pd.concat(result)
-        df.reset_index(drop=True, inplace=True) 
-               
-        return df            
+        first = list_bodies[0] if list_bodies else {}
+        request = {'coleccion': first.get('MetricId'), 'metrica': first.get('Entity'), 'entity_type': endpoint,
+                   'url': None, 'endpoint': endpoint, 'list_bodies': list_bodies, 'batched': False, 'raw': True,
+                   'chunks': [{'StartDate': body.get('StartDate'), 'EndDate': body.get('EndDate'), 'api': (None, None),
+                               'body': body, 'store': []} for body in list_bodies]}
+        data, failed_periods = await self.run_many([(None, request)], partial=partial)
+        if partial:
+            return data[None], failed_periods[None]
+        return data[None]
 
-    def request_data(self, coleccion, metrica, start_date, end_date, filtros=None):
-        """ request public server data from XM by the API
+    @staticmethod
+    def _periods(start_date, end_date, period='M') -> list:
+        """Splits the date range into calendar month (period='M') or year (period='Y') periods (StartDate, EndDate)
+        in YYYY-MM-DD format"""
+        end_periods = pd.date_range(start_date, end_date, freq=period + 'E', inclusive='both')
+        if len(end_periods) == 0 or end_periods[-1] != pd.Timestamp(end_date):
+            end_periods = end_periods.append(pd.DatetimeIndex([end_date]))
+
+        start_periods = [x.to_period(period).start_time for x in end_periods]
+        if (start_periods[0] != pd.Timestamp(start_date)) or (start_date == end_date):
+            start_periods[0] = pd.Timestamp(start_date)
+
+        return [(_start.strftime('%Y-%m-%d'), _end.strftime('%Y-%m-%d')) for _start, _end in zip(start_periods, end_periods)]
+
+    @staticmethod
+    def _max_days(entity_type, max_days=None) -> int:
+        """Maximum span in days (EndDate - StartDate) of one request, limited by the inventory MaxDays when it is valid"""
+        delta = period_dict[entity_type]['delta']
+        try:
+            max_days = int(max_days)
+        except (TypeError, ValueError):
+            return delta
+        return min(delta, max_days) if max_days > 0 else delta
+
+    def _plan(self, coleccion, metrica, filtros, start_date, end_date, max_days, period='M') -> list:
+        """ Plans the chunks of a date range. The months already in the local store are read from disk, the closed
+        months missing in the store are requested complete, and adjacent requests are merged while their span
+        does not exceed max_days. With period='Y' (annual entities) the chunks and the store follow calendar years,
+        so that no year is requested twice.
+        Returns:
+            list of chunks {'StartDate', 'EndDate', 'api': (StartDate, EndDate) of the request or None, 'body', 'store'}
+        """
+        chunks = []
+        for _start, _end in self._periods(start_date, end_date, period):
+            path = self._store_path(coleccion, metrica, filtros, _start, period)
+            chunk = {'StartDate': _start, 'EndDate': _end, 'api': (_start, _end), 'body': None, 'store': []}
+            if path is not None:
+                key = pd.Timestamp(_start).to_period(period)
+                period_range = (key.start_time.strftime('%Y-%m-%d'), key.end_time.strftime('%Y-%m-%d'))
+                chunk['store'] = [period_range + (path,)]
+                chunk['api'] = None if os.path.exists(path) else period_range
+
+            previous = chunks[-1] if chunks else None
+            if (previous is not None and previous['api'] is not None and chunk['api'] is not None
+                    and (pd.Timestamp(chunk['api'][1]) - pd.Timestamp(previous['api'][0])).days <= max_days):
+                previous['EndDate'] = chunk['EndDate']
+                previous['api'] = (previous['api'][0], chunk['api'][1])
+                previous['store'] += chunk['store']
+            else:
+                chunks.append(chunk)
+        return chunks
+
+    @staticmethod
+    def _check_filters(filtros) -> list | None:
+        """Filtros como lista de valores; None (después de avisar) si no son una lista, tupla o conjunto"""
+        if filtros is None:
+            return []
+        if isinstance(filtros, (list, tuple, set)):
+            return list(filtros)
+        print('Los filtros deben ingresarse como una lista de valores')
+        return None
+
+    def dry_run(self, coleccion, metrica, start_date, end_date, filtros=None) -> 'RequestPlan':
+        """ plans a request_data call without downloading data, to estimate its cost
         Args:
             coleccion: one of the set of variables availables at self.get_collections()
             metrica:one of this variables available in "ListadoMetricas", you have to enter MetricID
@@ -112,93 +879,567 @@ class ReadDB(object):
             end_date: end date consult data using YYYY-MM-DD format
             filter: optional parameter, list of values to filter data
         Returns: 
-            DataFrame with the raw Data
+            RequestPlan with the number of requests and the ranges requested to the API and read from the local store,
+            or None if the metric or the entity does not exist or the filters are not a list of values
         """
-        # self = cls()
-        if type(filtros) == list:
-            self.filtros = filtros
-        elif filtros == None:
-            self.filtros=[]
-        else:
-            print('Los filtros deben ingresarse como una lista de valores')
-            self.filtros = list
-            
-        if coleccion not in self.inventario_metricas.MetricId.values:
+        filtros = self._check_filters(filtros)
+        if filtros is None:
+            return None
+        request = self._build_request(coleccion, metrica, start_date, end_date, filtros)
+        if request is None:
+            return None
+        ranges = [chunk['api'] for chunk in request['chunks'] if chunk['api'] is not None]
+        local_ranges = [(chunk['StartDate'], chunk['EndDate']) for chunk in request['chunks'] if chunk['api'] is None]
+        return RequestPlan(coleccion, metrica, request['entity_type'], request['url'], ranges, local_ranges)
+
+    def _build_request(self, coleccion, metrica, start_date, end_date, filtros):
+        """ Validates the metric and plans the requests of the date range
+        Returns:
+            dict with entity_type, url, endpoint, chunks and list_bodies or None if the metric or the entity does not exist
+        """
+        start = time.perf_counter() if self.stats is not None else None
+        index = self.inventory_index()
+        if coleccion not in index['metrics']:
             print('No existe la métrica {}'.format(coleccion))
-            return pd.DataFrame()
+            return None
         
-        if metrica not in self.inventario_metricas.Entity.values:
+        metric = index['pairs'].get((coleccion, metrica))
+        if metric is None:
             print('No existe la entidad {}'.format(metrica))
-            return pd.DataFrame()
+            return None
         
-        # Generar periodos de inicio y fin de mes
-        end_periods = pd.date_range(start_date, end_date, freq='M', inclusive = 'both')    
-        if not  pd.Timestamp(end_date).is_month_end:
-            end_periods = end_periods.append(pd.DatetimeIndex([end_date]))
-        
-        start_periods = end_periods.map(lambda x: x - pd.offsets.MonthBegin(1))        
-        if (not pd.Timestamp(start_date).is_month_start) or (start_date==end_date):            
-            start_periods.values[0] = pd.Timestamp(start_date)            
-        
-        # Crear lista de periodos    
-        list_periods = list(zip(start_periods.astype(str), end_periods.astype(str)))
-        
-        period_dict = {
-            'HourlyEntities': {'period_base': 'hourly', 'delta': 30, 'endpoint': 'HourlyEntities'},
-            'DailyEntities': {'period_base': 'daily', 'delta': 30, 'endpoint': 'DailyEntities'},
-            'MonthlyEntities': {'period_base': 'monthly', 'delta': 732, 'endpoint': 'MonthlyEntities'},
-            'AnnualEntities': {'period_base': 'annual', 'delta': 366, 'endpoint': 'AnnualEntities'}
-        }
-        
-        entity_type = self.inventario_metricas.query("MetricId == @coleccion and Entity == @metrica").Type.values[0]
+        entity_type = metric['Type']
+        request = {'coleccion': coleccion, 'metrica': metrica, 'entity_type': entity_type,
+                   'url': None, 'endpoint': None, 'chunks': [], 'list_bodies': [], 'batched': False}
         
         if entity_type in period_dict:             
-            period_base = period_dict[entity_type]['period_base']
-            endpoint = period_dict[entity_type]['endpoint']
-            self.url = f'https://servapibi.xm.com.co/{period_base}'
+            request['endpoint'] = period_dict[entity_type]['endpoint']
+            request['url'] = self._endpoint_url(entity_type)
+            max_days = self._max_days(entity_type, metric.get('MaxDays'))
             
-            body_request = {
-                    "MetricId": coleccion,
-                    "StartDate": None,
-                    "EndDate": None,
-                    'Entity': metrica,
-                    "Filter": self.filtros
-            }
-            
-            list_bodies = []            
-            for _start, _end in list_periods:
-                temp_body = body_request.copy()
-                temp_body['StartDate'] = _start
-                temp_body['EndDate'] = _end
-                list_bodies.append(temp_body)
-          
-            
-            if __name__ == "__main__":    
+            # Las listas largas de filtros se dividen en lotes, cada lote se planea como una consulta más
+            batches = [filtros]
+            if self.filter_batch_size and len(filtros) > self.filter_batch_size:
+                filtros = list(dict.fromkeys(filtros))
+                batches = [filtros[i:i + self.filter_batch_size] for i in range(0, len(filtros), self.filter_batch_size)]
+                request['batched'] = len(batches) > 1
+
+            for batch in batches:
+                body_request = {
+                        "MetricId": coleccion,
+                        "StartDate": None,
+                        "EndDate": None,
+                        'Entity': metrica,
+                        "Filter": batch
+                }
+                
+                for chunk in self._plan(coleccion, metrica, batch, start_date, end_date, max_days,
+                                        period_dict[entity_type]['period']):
+                    if chunk['api'] is not None:
+                        temp_body = body_request.copy()
+                        temp_body['StartDate'], temp_body['EndDate'] = chunk['api']
+                        chunk['body'] = temp_body
+                        request['list_bodies'].append(temp_body)
+                    request['chunks'].append(chunk)
+            if request['batched']:
+                request['chunks'].sort(key=lambda chunk: chunk['StartDate'])
 
-                data = asyncio.run(self.run_async(list_bodies, endpoint))
+        elif entity_type == 'ListsEntities':
+            # Las listas no tienen fechas: un solo bloque sin almacenamiento local
+            request['url'] = self._endpoint_url(entity_type)
+            request['endpoint'] = 'ListEntities'
+            body_request = {'MetricId': coleccion, 'Entity': metrica}
+            request['chunks'] = [{'StartDate': None, 'EndDate': None, 'api': (None, None), 'body': body_request, 'store': []}]
+            request['list_bodies'].append(body_request)
 
-            else:
-                loop = asyncio.get_event_loop()
-                data = loop.run_until_complete(self.run_async(list_bodies, endpoint))
-            
+        self._add_phase('plan', start)
+        return request
+
+    def _add_phase(self, phase, start):
+        """Adds the seconds since start to a phase of self.stats. start is None when the stats are disabled"""
+        if start is not None:
+            self.stats.add_phase(phase, time.perf_counter() - start)
+
+    def _endpoint_url(self, entity_type) -> str:
+        """URL of the service of an entity type (or its endpoint), built from the self.url template"""
+        if entity_type in period_dict:
+            return self.url.format(period_base=period_dict[entity_type]['period_base'])
+        return self.url.format(period_base='lists')
+
+    @staticmethod
+    def _infer_schema(data: pd.DataFrame, columns) -> dict:
+        """ Classifies the columns of a response as numeric (with its dtype), category, date or other
+        Returns:
+            dict with the keys numeric, category, date and other
+        """
+        schema = {'numeric': {}, 'category': [], 'date': [], 'other': []}
+        for col in columns:
+            if col in ('Date', 'date'):
+                schema['date'].append(col)
+                continue
+            try:
+                schema['numeric'][col] = str(pd.to_numeric(data[col]).dtype)
+            except (ValueError, TypeError):
+                if pd.api.types.infer_dtype(data[col], skipna=True) == 'string':
+                    schema['category'].append(col)
+                else:
+                    schema['other'].append(col)
+        return schema
+
+    def _format_data(self, data: pd.DataFrame, coleccion, metrica) -> pd.DataFrame:
+        """ Casts the columns of a response with the schema of the metric, inferring it on the first request
+        Numeric columns are converted in one astype call, identifiers become category and Date is parsed as YYYY-MM-DD
+        """
+        if data.empty:
+            return data
+
+        start = time.perf_counter() if self.stats is not None else None
+        schemas = self._schemas()
+        key = '{}/{}'.format(coleccion, metrica)
+        schema = schemas.get(key, {'numeric': {}, 'category': [], 'date': [], 'other': []})
+        known = set(schema['numeric']) | set(schema['category']) | set(schema['date']) | set(schema['other'])
+        new_columns = [col for col in data.columns if col not in known]
+        changed = bool(new_columns)
+        if new_columns:
+            new_schema = self._infer_schema(data, new_columns)
+            schema = {kind: (dict(schema[kind], **new_schema[kind]) if kind == 'numeric' else schema[kind] + new_schema[kind])
+                      for kind in schema}
+
+        dtypes = {col: dtype for col, dtype in schema['numeric'].items() if col in data.columns}
+        dtypes.update({col: 'category' for col in schema['category'] if col in data.columns})
+        try:
+            data = data.astype(dtypes)
+        except (ValueError, TypeError):
+            # Algún periodo trae valores que no cumplen el esquema, se ajusta columna por columna
+            # sobre una copia del esquema, que puede estar compartido con otros hilos
+            data = data.copy()
+            schema = {kind: (dict(schema[kind]) if kind == 'numeric' else list(schema[kind])) for kind in schema}
+            for col, dtype in dtypes.items():
+                try:
+                    data[col] = data[col].astype(dtype)
+                except (ValueError, TypeError):
+                    changed = True
+                    try:
+                        data[col] = pd.to_numeric(data[col])
+                        schema['numeric'][col] = str(data[col].dtype)
+                    except (ValueError, TypeError):
+                        schema['numeric'].pop(col, None)
+                        schema['other'].append(col)
+
+        for col in schema['date']:
+            if col in data.columns:
+                try:
+                    data[col] = pd.to_datetime(data[col], format='%Y-%m-%d')
+                except (ValueError, TypeError):
+                    data[col] = pd.to_datetime(data[col], format='ISO8601', errors='coerce')
+
+        if changed:
+            self._update_schema(key, schema)
+        self._add_phase('coerce', start)
+        return data
+
+    def _present(self, data: pd.DataFrame, coleccion, metrica, shape='wide', tz=None, values_dtype=None, output='pandas'):
+        """Formats a response with _format_data and converts it to the requested shape with _reshape and the requested output"""
+        data = self._format_data(data, coleccion, metrica)
+        start = time.perf_counter() if self.stats is not None else None
+        data = self._to_output(self._reshape(data, shape, tz, values_dtype), output)
+        self._add_phase('reshape', start)
+        return data
+
+    @staticmethod
+    def _check_output(output):
+        if output not in outputs:
+            raise ValueError('output must be one of {}'.format(outputs))
+        if output != 'pandas' and pyarrow is None:
+            raise ImportError("output='{}' requires pyarrow: pip install pyarrow".format(output))
+        if output == 'polars' and polars is None:
+            raise ImportError("output='polars' requires polars: pip install polars")
+
+    @staticmethod
+    def _to_output(data: pd.DataFrame, output='pandas'):
+        """ Converts a formatted DataFrame to the requested output
+        The columns are already numeric, category or datetime, so Arrow reuses the numeric buffers and
+        converts the categories to dictionary arrays instead of building Python string objects again.
+        Returns:
+            pd.DataFrame, pyarrow.Table or polars.DataFrame
+        """
+        if output == 'pandas':
+            return data
+        table = pyarrow.Table.from_pandas(data, preserve_index=False)
+        if output == 'arrow':
+            return table
+        return polars.from_arrow(table)
 
-        elif self.inventario_metricas.query("MetricId == @coleccion and Entity == @metrica".format(coleccion, metrica)).Type.values == 'ListsEntities':
-            period_base = 'lists'
-            self.url = f'https://servapibi.xm.com.co/{period_base}'
-            self.request = {'MetricId': coleccion,
-                            'Entity': metrica}  
-            self.connection = requests.post(self.url, json=self.request)
-            data_json = json.loads(self.connection.content)
-            data = pd.json_normalize(data_json['Items'], 'ListEntities','Date', sep='_')
+    @staticmethod
+    def _reshape(data: pd.DataFrame, shape='wide', tz=None, values_dtype=None) -> pd.DataFrame:
+        """ Converts the Values_HourXX columns of an hourly response to the requested shape and dtype
+        Args:
+            data: formatted response of request_data
+            shape: 'wide' or 'long'
+            tz: optional timezone used to localize the Datetime column of the long shape
+            values_dtype: optional dtype of the values
+        Returns:
+            DataFrame in the requested shape
+        """
+        if shape not in ('wide', 'long'):
+            raise ValueError("shape must be 'wide' or 'long'")
+        hours = sorted((int(match.group(1)), col) for col in data.columns if (match := hour_column.match(col)))
+        hour_cols = [col for _, col in hours]
+        if not hour_cols:
+            if values_dtype is not None:
+                value_cols = [col for col in data.columns if col.startswith('Values_') and pd.api.types.is_float_dtype(data[col])]
+                data = data.astype({col: values_dtype for col in value_cols})
+            return data
+
+        if shape == 'wide' and values_dtype is None:
+            return data
+
+        # Matriz (filas, horas) contigua con todos los valores horarios
+        values = np.ascontiguousarray(data[hour_cols].to_numpy(dtype=values_dtype or 'float64', na_value=np.nan))
+        other_cols = [col for col in data.columns if col not in hour_cols]
+
+        if shape == 'wide':
+            frame = pd.DataFrame(values, columns=hour_cols, index=data.index, copy=False)
+            # Solo cambia el dtype, las columnas conservan el orden original
+            return pd.concat([data[other_cols], frame], axis=1)[data.columns]
+
+        n_rows, n_hours = values.shape
+        rows = np.repeat(np.arange(n_rows), n_hours)
+        result = data[[col for col in other_cols if col != 'Date']].iloc[rows].reset_index(drop=True)
+        offsets = (np.array([hour for hour, _ in hours]) - 1) * np.timedelta64(1, 'h')
+        dates = pd.to_datetime(data['Date']).to_numpy(dtype='datetime64[ns]')
+        timestamps = pd.DatetimeIndex((dates[:, None] + offsets[None, :]).ravel())
+        if tz is not None:
+            timestamps = timestamps.tz_localize(tz)
+        result['Datetime'] = timestamps
+        result['Value'] = values.ravel()
+        return result
+
+    async def _ensure_inventory(self):
+        """Loads the metric inventory without blocking the event loop"""
+        if self._inventario_metricas is None:
+            await asyncio.to_thread(lambda: self.inventario_metricas)
+
+    def request_data(self, coleccion, metrica, start_date, end_date, filtros=None, partial=False,
+                     shape='wide', tz=None, values_dtype=None, output='pandas'):
+        """ request public server data from XM by the API
+        Args:
+            coleccion: one of the set of variables availables at self.get_collections()
+            metrica:one of this variables available in "ListadoMetricas", you have to enter MetricID
+            start_date: start date consult data using YYYY-MM-DD format
+            end_date: end date consult data using YYYY-MM-DD format
+            filter: optional parameter, list of values to filter data
+            partial: optional parameter, if True the periods that fail after the retries are skipped
+            shape: optional parameter, 'wide' keeps the Values_HourXX columns of HourlyEntities, 'long' returns one row
+                   per hour with the columns Datetime (start of the hour) and Value
+            tz: optional parameter, timezone used to localize Datetime in the long shape, e.g. 'America/Bogota'
+            values_dtype: optional parameter, dtype of the values, e.g. 'float32'. The hourly values are stored in one contiguous 2-D array
+            output: optional parameter, 'pandas', 'arrow' (pyarrow.Table) or 'polars' (polars.DataFrame)
+        Returns: 
+            DataFrame with the raw Data. If partial is True, a tuple (DataFrame, list of failed (StartDate, EndDate) periods)
+        """
+        return self._run(self.request_data_async(coleccion, metrica, start_date, end_date, filtros, partial,
+                                                 shape, tz, values_dtype, output))
+
+    async def request_data_async(self, coleccion, metrica, start_date, end_date, filtros=None, partial=False,
+                                 shape='wide', tz=None, values_dtype=None, output='pandas'):
+        """ request public server data from XM by the API inside the running event loop
+        Args:
+            coleccion: one of the set of variables availables at self.get_collections()
+            metrica:one of this variables available in "ListadoMetricas", you have to enter MetricID
+            start_date: start date consult data using YYYY-MM-DD format
+            end_date: end date consult data using YYYY-MM-DD format
+            filter: optional parameter, list of values to filter data
+            partial: optional parameter, if True the periods that fail after the retries are skipped
+            shape: optional parameter, 'wide' keeps the Values_HourXX columns of HourlyEntities, 'long' returns one row
+                   per hour with the columns Datetime (start of the hour) and Value
+            tz: optional parameter, timezone used to localize Datetime in the long shape, e.g. 'America/Bogota'
+            values_dtype: optional parameter, dtype of the values, e.g. 'float32'. The hourly values are stored in one contiguous 2-D array
+            output: optional parameter, 'pandas', 'arrow' (pyarrow.Table) or 'polars' (polars.DataFrame)
+        Returns: 
+            DataFrame with the raw Data. If partial is True, a tuple (DataFrame, list of failed (StartDate, EndDate) periods)
+        """
+        self._check_output(output)
+        filtros = self._check_filters(filtros)
+        if filtros is None:
+            data = self._to_output(pd.DataFrame(), output)
+            return (data, []) if partial else data
+            
+        await self._ensure_inventory()
+        request = self._build_request(coleccion, metrica, start_date, end_date, filtros)
+        if request is None:
+            data = self._to_output(pd.DataFrame(), output)
+            return (data, []) if partial else data
         
-        cols = data.columns
-        for col in cols:
-            data[col] = pd.to_numeric(data[col],errors='ignore')
-        if ('Date' or 'date') in cols:
-            data['Date'] = pd.to_datetime(data['Date'],errors='ignore', format= '%Y-%m-%d')
+        frames, failed = await self.run_many([(None, request)], partial=partial)
+        data, failed_periods = frames[None], failed[None]
+        
+        data = self._present(data, coleccion, metrica, shape, tz, values_dtype, output)
     
+        if partial:
+            return data, failed_periods
         return data
 
+    def iter_data(self, coleccion, metrica, start_date, end_date, filtros=None, prefetch=None, partial=False,
+                  shape='wide', tz=None, values_dtype=None, output='pandas'):
+        """ request public server data from XM by the API yielding one DataFrame per period as each one completes
+        Only the periods inside the prefetch window are kept in memory, so the memory does not grow with the date range.
+        Args:
+            coleccion: one of the set of variables availables at self.get_collections()
+            metrica:one of this variables available in "ListadoMetricas", you have to enter MetricID
+            start_date: start date consult data using YYYY-MM-DD format
+            end_date: end date consult data using YYYY-MM-DD format
+            filter: optional parameter, list of values to filter data
+            prefetch: optional parameter, maximum number of periods requested ahead of the consumer. By default self.max_concurrency
+            partial: optional parameter, if True the periods that fail after the retries are skipped
+            shape, tz, values_dtype, output: optional parameters, see request_data
+        Yields: 
+            DataFrame with the formatted data of one period
+        """
+        iterator = self.aiter_data(coleccion, metrica, start_date, end_date, filtros, prefetch, partial, shape, tz,
+                                   values_dtype, output)
+        try:
+            while True:
+                data = self._run(_anext(iterator))
+                if data is _end_of_iteration:
+                    break
+                yield data
+        finally:
+            self._run(iterator.aclose())
+
+    async def aiter_data(self, coleccion, metrica, start_date, end_date, filtros=None, prefetch=None, partial=False,
+                         shape='wide', tz=None, values_dtype=None, output='pandas'):
+        """ asynchronous version of iter_data for the running event loop
+        Yields: 
+            DataFrame with the formatted data of one period
+        """
+        self._check_output(output)
+        filtros = self._check_filters(filtros)
+        if filtros is None:
+            return
+        await self._ensure_inventory()
+        request = self._build_request(coleccion, metrica, start_date, end_date, filtros)
+        if request is None:
+            return
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        prefetch = prefetch or self.max_concurrency
+        chunks = iter(request['chunks'])
+        pending = {}
+        try:
+            while True:
+                while len(pending) < prefetch:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    task = asyncio.ensure_future(self._get_period(request, chunk, semaphore))
+                    pending[task] = chunk
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    chunk = pending.pop(task)
+                    try:
+                        data = task.result()
+                    except Exception as error:
+                        if not partial:
+                            raise
+                        print('Falló la consulta del periodo {} - {}: {!r}'.format(chunk['StartDate'], chunk['EndDate'], error))
+                        continue
+                    yield self._present(data, coleccion, metrica, shape, tz, values_dtype, output)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def request_many(self, specs, partial=False, shape='wide', tz=None, values_dtype=None, output='pandas'):
+        """ request several metrics from XM by the API in a single batch
+        All the periods of all the specs share the same connection pool and concurrency limit,
+        so the total time approaches the slowest period instead of the sum of the queries.
+        Args:
+            specs: list of (coleccion, metrica, start_date, end_date[, filtros]) tuples or dicts with those keys.
+                   A dict {name: spec} uses its keys to identify the results
+            partial: optional parameter, if True the periods that fail after the retries are skipped
+            shape, tz, values_dtype, output: optional parameters applied to every spec, see request_data
+        Returns: 
+            dict {spec: DataFrame with the raw Data}, where spec is (coleccion, metrica, start_date, end_date, tuple(filtros)) 
+            or the key given by the user. If partial is True, a tuple (dict of DataFrames, dict {spec: list of failed periods})
+        """
+        return self._run(self.request_many_async(specs, partial, shape, tz, values_dtype, output))
+
+    async def request_many_async(self, specs, partial=False, shape='wide', tz=None, values_dtype=None, output='pandas'):
+        """ request several metrics from XM by the API in a single batch inside the running event loop
+        Args:
+            specs: list of (coleccion, metrica, start_date, end_date[, filtros]) tuples or dicts with those keys.
+                   A dict {name: spec} uses its keys to identify the results
+            partial: optional parameter, if True the periods that fail after the retries are skipped
+            shape, tz, values_dtype, output: optional parameters applied to every spec, see request_data
+        Returns: 
+            dict {spec: DataFrame with the raw Data}, where spec is (coleccion, metrica, start_date, end_date, tuple(filtros)) 
+            or the key given by the user. If partial is True, a tuple (dict of DataFrames, dict {spec: list of failed periods})
+        """
+        self._check_output(output)
+        if isinstance(specs, dict):
+            items = list(specs.items())
+        else:
+            items = [(None, spec) for spec in specs]
+
+        await self._ensure_inventory()
+        results = {}
+        failed = {}
+        jobs = []
+        keys = []
+        for key, spec in items:
+            if isinstance(spec, dict):
+                coleccion, metrica = spec['coleccion'], spec['metrica']
+                start_date, end_date = spec.get('start_date'), spec.get('end_date')
+                filtros = spec.get('filtros')
+            else:
+                coleccion, metrica, start_date, end_date, *filtros = spec
+                filtros = filtros[0] if filtros else None
+            checked = self._check_filters(filtros)
+            if key is None:
+                key = (coleccion, metrica, start_date, end_date, tuple(checked) if checked is not None else filtros)
+            if key in keys:
+                # La misma consulta repetida, el resultado tiene un solo DataFrame por llave
+                continue
+            keys.append(key)
+
+            request = self._build_request(coleccion, metrica, start_date, end_date, checked) if checked is not None else None
+            if request is None:
+                results[key] = self._to_output(pd.DataFrame(), output)
+                failed[key] = []
+            else:
+                jobs.append((key, request))
+
+        frames, failed_jobs = await self.run_many(jobs, partial=partial)
+        for key, request in jobs:
+            results[key] = self._present(frames[key], request['coleccion'], request['metrica'], shape, tz, values_dtype, output)
+            failed[key] = failed_jobs[key]
+        results = {key: results[key] for key in keys}
+
+        if partial:
+            return results, failed
+        return results
+
+    async def _get_period(self, request, chunk, semaphore=None) -> pd.DataFrame:
+        """
+            Obtiene los datos de un bloque del plan, desde el almacenamiento local o desde la API.
+            Los meses cerrados descargados se guardan uno por uno en el almacenamiento local.
+
+            Args:
+                request (dict): Solicitud generada por _build_request.
+                chunk (dict): Bloque del plan generado por _plan.
+                semaphore (asyncio.Semaphore): Opcional, limita el número de solicitudes simultáneas.
+
+            Returns:
+                pd.DataFrame: Los datos del bloque entre su StartDate y EndDate.
+        """
+        if chunk['body'] is None:
+            frames = [await asyncio.to_thread(self._read_store, path) for _, _, path in chunk['store']]
+            data = pd.concat(frames) if len(frames) > 1 else frames[0]
+        else:
+            data = await self.async_get_df(chunk['body'], request['endpoint'], semaphore, url=request['url'])
+            if self.store_dir is not None and not request.get('raw'):
+                data = self._format_data(data, request['coleccion'], request['metrica'])
+            if chunk['store'] and (data.empty or 'Date' in data.columns):
+                dates = pd.to_datetime(data['Date']) if not data.empty else None
+                for period_start, period_end, path in chunk['store']:
+                    period_data = data if dates is None else data[(dates >= period_start) & (dates <= period_end)]
+                    await asyncio.to_thread(self._write_store, path, period_data.reset_index(drop=True))
+
+        if chunk['store'] and 'Date' in data.columns and not data.empty:
+            start = pd.Timestamp(chunk['StartDate'])
+            # Los datos mensuales y anuales tienen la fecha del inicio del mes o del año
+            if request['entity_type'] == 'AnnualEntities':
+                start = start.replace(month=1, day=1)
+            elif request['entity_type'] == 'MonthlyEntities':
+                start = start.replace(day=1)
+            dates = pd.to_datetime(data['Date'])
+            data = data[(dates >= start) & (dates <= pd.Timestamp(chunk['EndDate']))]
+        return data.reset_index(drop=True)
+
+    def _store_path(self, coleccion, metrica, filtros, start_date, period='M') -> str | None:
+        """Ruta del mes (o del año con period='Y') en el almacenamiento local o None si el almacenamiento está
+        deshabilitado o el periodo sigue abierto"""
+        if self.store_dir is None:
+            return None
+        key = pd.Timestamp(start_date).to_period(period)
+        if key.asfreq('M', how='end') >= pd.Timestamp.now().to_period('M') - self.settlement_months:
+            return None
+        filter_hash = hashlib.sha1(json.dumps(sorted(map(str, filtros))).encode('utf-8')).hexdigest()[:12] if filtros else 'all'
+        extension = 'parquet' if pyarrow is not None else 'pkl'
+        return os.path.join(self.store_dir, coleccion, metrica, filter_hash, '{}.{}'.format(key, extension))
+
+    @staticmethod
+    def _read_store(path) -> pd.DataFrame:
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path)
+        return pd.read_pickle(path)
+
+    @staticmethod
+    def _write_store(path, data: pd.DataFrame):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            if path.endswith('.parquet'):
+                data.to_parquet(temp_path, index=False)
+            else:
+                data.to_pickle(temp_path)
+            os.replace(temp_path, path)
+        except (OSError, ValueError, TypeError) as error:
+            print('No fue posible guardar el periodo en {}: {!r}'.format(path, error))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def run_many(self, jobs, partial=False):
+        """
+            Ejecuta en paralelo todos los periodos de varias consultas compartiendo la sesión
+            y el límite de solicitudes simultáneas, y concatena los resultados de cada consulta.
+            Si el objeto tiene almacenamiento local, los meses cerrados ya guardados no se descargan.
+
+            Args:
+                jobs (list): Lista de tuplas (llave, solicitud) generadas por _build_request.
+                partial (bool): Si es True, los periodos que fallan no interrumpen la consulta.
+
+            Returns:
+                tuple: (dict {llave: DataFrame}, dict {llave: lista de periodos fallidos})
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks = []
+        for key, request in jobs:
+            for chunk in request['chunks']:
+                task = asyncio.ensure_future(self._get_period(request, chunk, semaphore))
+                tasks.append((key, request, chunk, task))
+        try:
+            result = await asyncio.gather(*[task for *_, task in tasks], return_exceptions=partial)
+        except BaseException:
+            for *_, task in tasks:
+                task.cancel()
+            raise
+
+        frames = {key: [] for key, _ in jobs}
+        failed_periods = {key: [] for key, _ in jobs}
+        for (key, request, chunk, _), item in zip(tasks, result):
+            if isinstance(item, BaseException):
+                print('Falló la consulta de {} {} en el periodo {} - {}: {!r}'.format(
+                    request['coleccion'], request['metrica'], chunk['StartDate'], chunk['EndDate'], item))
+                failed_periods[key].append((chunk['StartDate'], chunk['EndDate']))
+            else:
+                frames[key].append(item)
+
+        start = time.perf_counter() if self.stats is not None else None
+        data = {}
+        for key, request in jobs:
+            list_frames = frames[key]
+            data[key] = pd.concat(list_frames).reset_index(drop=True) if list_frames else pd.DataFrame()
+            if request['batched']:
+                data[key] = data[key].drop_duplicates(ignore_index=True)
+                if 'Date' in data[key].columns:
+                    # Orden estable por fecha: dentro de cada fecha los lotes quedan en el orden de los filtros, como sin lotes
+                    data[key] = data[key].sort_values('Date', kind='stable', ignore_index=True)
+        self._add_phase('concat', start)
+        return data, failed_periods
+
 if __name__ == "__main__":
     consult = ReadDB()
     metricas: pd.DataFrame = consult.get_collections()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in of the API XM to measure ReadDB without calling servapibi.xm.com.co
+
+The server answers the POST requests of /Lists, /hourly, /daily, /monthly and /annual with the structure
+of the API XM. The responses come from recorded fixtures (a folder with one JSON file per request) or are
+generated synthetically and deterministically from the body of the request, with configurable latency and
+error rate.
+
+Usage:
+    from pydataxm.pydataxm import ReadDB
+    from pydataxm.replay import ReplayServer
+
+    with ReplayServer(latency=0.05) as server:
+        df = ReadDB(base_url=server.url).request_data('Gene', 'Recurso', '2024-01-01', '2024-03-31')
+
+    python -m pydataxm.replay --port 8765 --latency 0.05 --error-rate 0.01
+"""
+
+import os
+import json
+import zlib
+import random
+import hashlib
+import argparse
+import asyncio
+import threading
+import datetime as dt
+from collections import Counter, OrderedDict
+
+import pandas as pd
+import aiohttp
+from aiohttp import web
+
+endpoints = {
+    'hourly': ('HourlyEntities', 'D'),
+    'daily': ('DailyEntities', 'D'),
+    'monthly': ('MonthlyEntities', 'MS'),
+    'annual': ('AnnualEntities', 'YS'),
+}
+max_days = {'HourlyEntities': 30, 'DailyEntities': 30, 'MonthlyEntities': 731, 'AnnualEntities': 366, 'ListsEntities': 0}
+
+# (MetricId, MetricName, Entity, Type, MetricUnits) del inventario sintético
+default_metrics = [
+    ('Gene', 'Generacion Real', 'Sistema', 'HourlyEntities', 'kWh'),
+    ('Gene', 'Generacion Real por Recurso', 'Recurso', 'HourlyEntities', 'kWh'),
+    ('DemaCome', 'Demanda Comercial', 'Sistema', 'HourlyEntities', 'kWh'),
+    ('DemaCome', 'Demanda Comercial por Agente', 'Agente', 'HourlyEntities', 'kWh'),
+    ('PrecBolsNaci', 'Precio de Bolsa Nacional', 'Sistema', 'HourlyEntities', 'COP/kWh'),
+    ('AporEner', 'Aportes Energia', 'Sistema', 'DailyEntities', 'kWh'),
+    ('AporEner', 'Aportes Energia por Rio', 'Rio', 'DailyEntities', 'kWh'),
+    ('VoluUtilDiarEner', 'Volumen Util Diario', 'Sistema', 'DailyEntities', 'kWh'),
+    ('VoluUtilDiarEner', 'Volumen Util Diario por Embalse', 'Embalse', 'DailyEntities', 'kWh'),
+    ('PrecEsca', 'Precio de Escasez', 'Sistema', 'DailyEntities', 'COP/kWh'),
+    ('CERE', 'CERE', 'Sistema', 'MonthlyEntities', 'COP/kWh'),
+    ('CEE', 'CEE', 'Sistema', 'MonthlyEntities', 'COP/kWh'),
+    ('ReplayAnual', 'Metrica anual sintetica', 'Sistema', 'AnnualEntities', 'kWh'),
+    ('ListadoMetricas', 'Inventario Metricas API XM', 'Sistema', 'ListsEntities', ''),
+    ('ListadoRecursos', 'Listado Recursos', 'Sistema', 'ListsEntities', ''),
+    ('ListadoAgentes', 'Listado Agentes', 'Sistema', 'ListsEntities', ''),
+    ('ListadoRios', 'Listado Rios', 'Sistema', 'ListsEntities', ''),
+    ('ListadoEmbalses', 'Listado Embalses', 'Sistema', 'ListsEntities', ''),
+]
+
+
+def fixture_key(path: str, body: dict) -> str:
+    """Name of the fixture file of a request"""
+    text = json.dumps({'path': path.strip('/').lower(), 'body': body}, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest() + '.json'
+
+
+class ReplayServer(object):
+    """This object serves the API XM from fixtures on a local port, in a background thread"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 503, codes: int = 20, fixtures_dir: str | None = None,
+                 upstream: str | None = None, strict: bool = False, metrics: list | None = None, seed: int = 0,
+                 response_cache: int = 512, compression: bool = False):
+        """
+        Args:
+            host: optional parameter, address where the server listens
+            port: optional parameter, port where the server listens. 0 chooses a free port
+            latency: optional parameter, seconds added to every response
+            jitter: optional parameter, maximum random seconds added to the latency
+            error_rate: optional parameter, fraction of the requests answered with error_status
+            error_status: optional parameter, HTTP status of the simulated errors
+            codes: optional parameter, number of codes (resources, agents, ...) of the entities other than Sistema
+            fixtures_dir: optional parameter, folder of the recorded responses, one JSON file per request (see fixture_key)
+            upstream: optional parameter, URL of the real API. The requests without fixture are forwarded to it and recorded
+                      in fixtures_dir
+            strict: optional parameter, if True the requests without fixture are answered with 404 instead of synthetic data
+            metrics: optional parameter, list of (MetricId, MetricName, Entity, Type, MetricUnits) of the inventory
+            seed: optional parameter, seed of the synthetic values and of the simulated errors
+            response_cache: optional parameter, number of synthetic responses kept in memory, so that the cost of
+                            generating them does not count in repeated measures
+            compression: optional parameter, if True the responses are compressed with the Accept-Encoding of the request
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.codes = codes
+        self.fixtures_dir = fixtures_dir
+        self.upstream = upstream.rstrip('/') if upstream else None
+        self.strict = strict
+        self.metrics = metrics if metrics is not None else default_metrics
+        self.seed = seed
+        self.response_cache = response_cache
+        self.compression = compression
+        self._responses = OrderedDict()
+        self.requests = Counter()
+        self.errors = 0
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._loop = None
+        self._thread = None
+        self._runner = None
+        self._session = None
+
+    @property
+    def url(self) -> str:
+        """Root URL of the server, to be used as ReadDB(base_url=...)"""
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def reset(self):
+        """Resets the request counters"""
+        self.requests = Counter()
+        self.errors = 0
+        self.bytes_sent = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/{path}', self.handle)
+        return app
+
+    def start(self):
+        """Starts the server in a background thread and waits until it accepts connections"""
+        if self._thread is not None:
+            return self
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='pydataxm-replay', daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def stop(self):
+        """Stops the server and its thread"""
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self._thread = None
+
+    async def _stop(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await self._runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path = request.match_info['path'].lower()
+        self.requests[path] += 1
+        body = await request.json()
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=self.error_status)
+
+        content = await self._fixture(request.match_info['path'], body)
+        if content is None:
+            if self.strict:
+                return web.Response(status=404)
+            content = self._synthetic(path, body)
+            if content is None:
+                return web.Response(status=404)
+        self.bytes_sent += len(content)
+        response = web.Response(body=content, content_type='application/json')
+        if self.compression:
+            response.enable_compression()
+        return response
+
+    async def _fixture(self, path: str, body: dict) -> bytes | None:
+        """Recorded response of the request, downloaded from upstream and recorded when it is missing"""
+        if self.fixtures_dir is None:
+            return None
+        file_path = os.path.join(self.fixtures_dir, fixture_key(path, body))
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as file:
+                return file.read()
+        if self.upstream is None:
+            return None
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        async with self._session.post('{}/{}'.format(self.upstream, path), json=body) as response:
+            response.raise_for_status()
+            content = await response.read()
+        os.makedirs(self.fixtures_dir, exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+        os.replace(temp_path, file_path)
+        return content
+
+    def _synthetic(self, path: str, body: dict) -> bytes | None:
+        key = fixture_key(path, body)
+        content = self._responses.get(key)
+        if content is not None:
+            self._responses.move_to_end(key)
+            return content
+        if path == 'lists':
+            items = self.list_items(body)
+        elif path in endpoints:
+            items = self.period_items(path, body)
+        else:
+            return None
+        content = json.dumps({'Items': items}).encode('utf-8')
+        if self.response_cache > 0:
+            self._responses[key] = content
+            while len(self._responses) > self.response_cache:
+                self._responses.popitem(last=False)
+        return content
+
+    def _codes(self, entity: str, filtros) -> list:
+        if filtros:
+            return list(filtros)
+        if entity == 'Sistema':
+            return ['Sistema']
+        return ['{}{:03d}'.format(entity[:3].upper(), i) for i in range(self.codes)]
+
+    def _values(self, *key) -> random.Random:
+        """Generador de valores que depende solo de la llave, para responder igual a la misma solicitud"""
+        return random.Random(zlib.crc32(json.dumps([self.seed, *key]).encode('utf-8')))
+
+    def period_items(self, path: str, body: dict) -> list:
+        """Synthetic Items of a periodic endpoint between StartDate and EndDate"""
+        endpoint, freq = endpoints[path]
+        metric_id, entity = body.get('MetricId'), body.get('Entity')
+        start, end = pd.Timestamp(body['StartDate']), pd.Timestamp(body['EndDate'])
+        if freq == 'MS':
+            start = start.replace(day=1)
+        elif freq == 'YS':
+            start = start.replace(month=1, day=1)
+        codes = self._codes(entity, body.get('Filter'))
+        items = []
+        for date in pd.date_range(start, end, freq=freq):
+            day = date.strftime('%Y-%m-%d')
+            records = []
+            for code in codes:
+                values = self._values(metric_id, entity, day, code)
+                record = {'code': code}
+                if endpoint == 'HourlyEntities':
+                    record.update({'Hour{:02d}'.format(hour): '{:.4f}'.format(values.uniform(0, 1000)) for hour in range(1, 25)})
+                else:
+                    record['Value'] = '{:.4f}'.format(values.uniform(0, 1000))
+                records.append({'Id': entity, 'Values': record})
+            items.append({'Date': day, endpoint: records})
+        return items
+
+    def list_items(self, body: dict) -> list:
+        """Synthetic Items of /Lists, including the metric inventory of ListadoMetricas"""
+        metric_id, entity = body.get('MetricId'), body.get('Entity') or 'Sistema'
+        if metric_id == 'ListadoMetricas':
+            records = [{'Id': 'Metrica', 'Values': {'MetricId': metric, 'MetricName': name, 'Entity': metric_entity,
+                                                    'MaxDays': max_days[metric_type], 'Type': metric_type, 'Url': '',
+                                                    'Filter': 'NA' if metric_entity == 'Sistema' else metric_entity,
+                                                    'MetricUnits': units, 'MetricDescription': name}}
+                       for metric, name, metric_entity, metric_type, units in self.metrics]
+        else:
+            records = []
+            for code in self._codes(metric_id.replace('Listado', '').rstrip('s') or 'Codigo', body.get('Filter')):
+                values = self._values(metric_id, entity, code)
+                records.append({'Id': entity, 'Values': {'Code': code, 'Name': 'Nombre {}'.format(code),
+                                                          'Type': values.choice(['HIDRAULICA', 'TERMICA', 'SOLAR', 'EOLICA']),
+                                                          'Capacity': '{:.2f}'.format(values.uniform(0, 1000))}})
+        return [{'Date': dt.date.today().strftime('%Y-%m-%d'), 'ListEntities': records}]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of the API XM')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--codes', type=int, default=20)
+    parser.add_argument('--fixtures-dir', default=None)
+    parser.add_argument('--upstream', default=None)
+    parser.add_argument('--strict', action='store_true')
+    parser.add_argument('--compression', action='store_true')
+    args = parser.parse_args()
+
+    server = ReplayServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.error_status,
+                          args.codes, args.fixtures_dir, args.upstream, args.strict, compression=args.compression)
+    print('API XM replay en {}'.format(server.url))
+    web.run_app(server.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
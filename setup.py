@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='pydataxm',
     version='0.3.17',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     license='MIT',
     description='Interface to interact with API XM and API SIMEM',
     author='Equipo Analitica XM',
@@ -16,9 +16,14 @@ setup(
         'numpy',
         'requests',
         'aiohttp',
-        'asyncio',
-        'nest_asyncio'
+        'asyncio'
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'store': ['pyarrow'],
+        'arrow': ['pyarrow'],
+        'polars': ['pyarrow', 'polars'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',